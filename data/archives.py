@@ -0,0 +1,226 @@
+"""
+Image bytes read directly from zip and tar archives, without extracting them.
+
+The central directory of every zip, and the member headers of every tar, are read
+once to build an index from member name to (archive, offset, length), stored as a
+sorted structured numpy array next to a small manifest. Each process memory-maps
+the index and the archives lazily, and members are sliced out of the archive and
+inflated on the fly, so DataLoader workers decode images straight from the
+archives downloaded by scripts/download-dataset.py.
+"""
+
+import os
+import json
+import zlib
+import struct
+import hashlib
+import tarfile
+import zipfile
+from glob import glob
+from os.path import join, dirname, basename
+
+import numpy as np
+
+from data.image_cache import FileMaps
+from data.utils import save_array_atomic, save_json_atomic, file_lock
+
+# how the bytes of a member are stored in its archive
+TAR, ZIP_STORED, ZIP_DEFLATED = 0, 1, 2
+
+ZIP_LOCAL_HEADER = struct.Struct("<4s22xHH")  # signature, name and extra lengths
+ZIP_LOCAL_SIGNATURE = b"PK\x03\x04"
+
+
+def find_archives(image_folder):
+    """Lists the archives holding the images of image_folder: <image_folder>.zip,
+    <image_folder>.tar and the zip and tar files inside image_folder, sorted.
+    """
+    paths = [f"{image_folder}.zip", f"{image_folder}.tar"]
+    paths += glob(join(image_folder, "*.zip")) + glob(join(image_folder, "*.tar"))
+    return sorted(path for path in paths if os.path.isfile(path))
+
+
+def archives_signature(archives):
+    """Signature of a list of archives from their names, sizes and mtimes."""
+    entries = []
+    for path in archives:
+        stat = os.stat(path)
+        entries.append((basename(path), stat.st_size, stat.st_mtime_ns))
+    return hashlib.sha1(json.dumps(entries).encode()).hexdigest()
+
+
+def is_indexed(name):
+    base = basename(name)
+    return base != "" and not base.startswith(".") and "__MACOSX" not in name
+
+
+def list_members(path):
+    """Lists (name, offset, length, kind) of the files of an archive. The offset is
+    the one of the local header for zip members, of the data for tar members.
+    """
+    members = []
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or not is_indexed(info.filename):
+                    continue
+                if info.compress_type == zipfile.ZIP_STORED:
+                    kind = ZIP_STORED
+                elif info.compress_type == zipfile.ZIP_DEFLATED:
+                    kind = ZIP_DEFLATED
+                else:
+                    raise ValueError(
+                        f"{info.filename} of {path} uses an unsupported compression "
+                        f"method {info.compress_type}, only stored or deflated"
+                    )
+                members.append(
+                    (basename(info.filename), info.header_offset, info.compress_size, kind)
+                )
+    else:
+        # "r:" refuses compressed tars, whose members cannot be sliced out
+        with tarfile.open(path, "r:") as archive:
+            for info in archive:
+                if info.isfile() and is_indexed(info.name):
+                    members.append((basename(info.name), info.offset_data, info.size, TAR))
+    return members
+
+
+class ArchiveReader:
+    def __init__(self, image_folder, index_path, local_cache=None):
+        """Serves image bytes from the archives of image_folder, see find_archives.
+        The member index is built once and loaded from index_path afterwards, and the
+        index and the archives are mapped lazily in each process, so the reader can
+        be shared with DataLoader workers and between ranks.
+        Args:
+            image_folder (str): folder whose images are archived
+            index_path (str): path prefix of the index files (.npy, .json)
+            local_cache (data.image_cache.LocalFileCache): if set, the archives are
+                copied to a local disk on their first access and mapped from there,
+                see data.image_cache.FileMaps
+        """
+        self.image_folder = image_folder
+        self.index_path = index_path
+        self.local_cache = local_cache
+        self.archives = find_archives(image_folder)
+        if len(self.archives) == 0:
+            raise ValueError(f"No zip or tar archive found for {image_folder}")
+        if not self.is_valid():
+            self.build()
+        self._load_index()
+
+    def is_valid(self):
+        try:
+            with open(f"{self.index_path}.json") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return manifest.get("signature") == archives_signature(self.archives)
+
+    def build(self):
+        """Reads the central directory of every archive and persists the index,
+        once across processes.
+        """
+        os.makedirs(dirname(self.index_path), exist_ok=True)
+        with file_lock(f"{self.index_path}.lock"):
+            if self.is_valid():  # built by another rank while we were waiting
+                return
+            signature = archives_signature(self.archives)
+            print(f"Indexing the archives of {self.image_folder}")
+            members = []
+            for archive, path in enumerate(self.archives):
+                members += [(m, archive) for m in list_members(path)]
+            max_len = max([len(m[0].encode()) for m, _ in members], default=1)
+            index = np.empty(
+                len(members),
+                dtype=[
+                    ("name", f"S{max_len}"),
+                    ("archive", "<i4"),
+                    ("offset", "<i8"),
+                    ("length", "<i8"),
+                    ("kind", "u1"),
+                ],
+            )
+            index["name"] = [m[0].encode() for m, _ in members]
+            index["archive"] = [archive for _, archive in members]
+            index["offset"] = [m[1] for m, _ in members]
+            index["length"] = [m[2] for m, _ in members]
+            index["kind"] = [m[3] for m, _ in members]
+            index = index[np.argsort(index["name"], kind="stable")]
+            names = index["name"]
+            duplicated = names[1:][names[1:] == names[:-1]]
+            if len(duplicated) > 0:
+                raise ValueError(
+                    f"{duplicated[0].decode()} is stored several times in the "
+                    f"archives of {self.image_folder}"
+                )
+            save_array_atomic(f"{self.index_path}.npy", index)
+            save_json_atomic(
+                f"{self.index_path}.json",
+                {
+                    "signature": signature,
+                    "archives": [basename(path) for path in self.archives],
+                    "num_images": len(index),
+                },
+            )
+
+    def _load_index(self):
+        self.index = np.load(f"{self.index_path}.npy", mmap_mode="r")
+        self.names = self.index["name"]
+        self._maps = FileMaps(self.local_cache)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ["index", "names", "_maps"]:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load_index()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        name = name.encode()
+        pos = np.searchsorted(self.names, name)
+        return pos < len(self.names) and self.names[pos] == name
+
+    def _map(self, archive):
+        return self._maps[self.archives[archive]]
+
+    def locate(self, name):
+        """Returns the (archive, offset, length, kind) of a member."""
+        key = name.encode()
+        pos = np.searchsorted(self.names, key)
+        if pos >= len(self.names) or self.names[pos] != key:
+            raise KeyError(f"{name} not found in the archives of {self.image_folder}")
+        entry = self.index[pos]
+        return (
+            int(entry["archive"]),
+            int(entry["offset"]),
+            int(entry["length"]),
+            int(entry["kind"]),
+        )
+
+    def read(self, name):
+        """Returns the bytes of a member, as a memoryview into its archive unless
+        it is compressed.
+        """
+        archive, offset, length, kind = self.locate(name)
+        data = self._map(archive)
+        if kind != TAR:
+            # the local header repeats the name, with an extra field that may differ
+            # from the one of the central directory
+            signature, name_length, extra_length = ZIP_LOCAL_HEADER.unpack_from(
+                data, offset
+            )
+            if signature != ZIP_LOCAL_SIGNATURE:
+                raise ValueError(
+                    f"Bad zip local header for {name} in {self.archives[archive]}"
+                )
+            offset += ZIP_LOCAL_HEADER.size + name_length + extra_length
+        member = memoryview(data)[offset : offset + length]
+        if kind == ZIP_DEFLATED:
+            return zlib.decompress(member, -zlib.MAX_WBITS)
+        return member
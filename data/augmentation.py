@@ -3,11 +3,29 @@ Adapted from https://github.com/nv-nguyen/template-pose/blob/main/src/utils/augm
 """
 
 from torchvision import transforms
+from torchvision.transforms import functional as TF
 from PIL import ImageEnhance, ImageFilter, Image
+import math
+import multiprocessing
+import os
 import numpy as np
 import random
 import logging
-from torchvision.transforms import RandomResizedCrop, ToTensor
+import torch
+import torch.nn.functional as F
+from torchvision.transforms import (
+    Compose,
+    CenterCrop,
+    InterpolationMode,
+    RandomHorizontalFlip,
+    RandomResizedCrop,
+    RandomRotation,
+    RandomVerticalFlip,
+    Resize,
+    ToTensor,
+)
+
+from data.tensor_cache import split_transforms
 
 
 class PillowRGBAugmentation:
@@ -94,21 +112,117 @@ class PillowBlur:
         return PIL_image
 
 
+class BottomBlur:
+    def __init__(self, rows=14, kernel_size=13, sigma=2.0):
+        """Gaussian blur of the bottom rows of an image, where street view images
+        carry their watermark. Only the strip is converted to float and blurred, then
+        pasted back, which gives the same pixels as blurring the rows of the whole
+        image converted with ToTensor and back with ToPILImage.
+        Args:
+            rows (int): number of rows to blur, at the resolution of the image
+            kernel_size (int): size of the gaussian kernel
+            sigma (float): standard deviation of the gaussian kernel
+        """
+        self.rows = rows
+        self.kernel_size = [kernel_size, kernel_size]
+        self.sigma = [sigma, sigma]
+
+    def __call__(self, PIL_image):
+        """Blurs the bottom rows of the image in place and returns it."""
+        width, height = PIL_image.size
+        box = (0, max(height - self.rows, 0), width, height)
+        strip = TF.pil_to_tensor(PIL_image.crop(box)).float().div_(255)
+        strip = TF.gaussian_blur(strip, self.kernel_size, self.sigma)
+        # truncated as in ToPILImage
+        strip = TF.to_pil_image(strip.mul_(255).byte(), mode=PIL_image.mode)
+        PIL_image.paste(strip, box)
+        return PIL_image
+
+
+class ProgressiveResize:
+    def __init__(self, size=224, interpolation=3):
+        """Resize of the shorter side followed by a square center crop, like the
+        first two steps of fast_clip, at a size that can change during training.
+        The size is kept in shared memory, so that set_size also reaches the
+        DataLoader workers that are already running.
+        Args:
+            size (int): initial size of the output images
+            interpolation (int): interpolation of the resize, bicubic by default
+        """
+        self.size = multiprocessing.RawValue("i", size)
+        self.interpolation = interpolation
+        self._transforms = {}
+
+    def set_size(self, size):
+        self.size.value = size
+
+    def __call__(self, PIL_image):
+        size = self.size.value
+        if size not in self._transforms:
+            self._transforms[size] = Compose(
+                [
+                    transforms.Resize(
+                        size, interpolation=self.interpolation, antialias=True
+                    ),
+                    transforms.CenterCrop(size),
+                ]
+            )
+        return self._transforms[size](PIL_image)
+
+
+def find_transforms(transform, cls):
+    """Returns the transforms of type cls nested in a Compose or ImageAugmentation."""
+    if isinstance(transform, cls):
+        return [transform]
+    if isinstance(transform, Compose):
+        children = transform.transforms
+    elif isinstance(transform, ImageAugmentation):
+        children = transform.transforms.values()
+    else:
+        return []
+    return [found for child in children for found in find_transforms(child, cls)]
+
+
 class NumpyGaussianNoise:
     def __init__(self, p, factor_interval=(0.01, 0.3)):
         self.noise_ratio = random.uniform(*factor_interval)
         self.p = p
+        # float32 noise buffer and generator of the current process, see noise_buffer
+        self._pid = None
+        self._rng = None
+        self._buffer = np.empty(0, dtype=np.float32)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_pid"], state["_rng"] = None, None
+        state["_buffer"] = np.empty(0, dtype=np.float32)
+        return state
+
+    def noise_buffer(self, shape):
+        """Returns the reused float32 buffer of the given shape, filled with standard
+        gaussian noise. The generator is seeded from python random in each process,
+        which the DataLoader seeds differently in every worker.
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._rng = np.random.default_rng(random.getrandbits(64))
+        size = int(np.prod(shape))
+        if self._buffer.size < size:
+            self._buffer = np.empty(size, dtype=np.float32)
+        buffer = self._buffer[:size].reshape(shape)
+        self._rng.standard_normal(dtype=np.float32, out=buffer)
+        return buffer
 
     def __call__(self, img):
         if random.random() <= self.p:
-            img = np.copy(img)
+            img = np.asarray(img)
             noisesigma = random.uniform(0, self.noise_ratio)
-            gauss = np.random.normal(0, noisesigma, img.shape) * 255
-            img = img + gauss
-
-            img[img > 255] = 255
-            img[img < 0] = 0
-        return Image.fromarray(np.uint8(img))
+            noise = self.noise_buffer(img.shape)
+            noise *= noisesigma * 255
+            noise += img
+            np.clip(noise, 0, 255, out=noise)
+            return Image.fromarray(noise.astype(np.uint8))
+        return img
 
 
 class StandardAugmentation:
@@ -167,10 +281,395 @@ class GeometricAugmentation:
         return img
 
 
+class CanvasResize:
+    def __init__(self, size, interpolation=InterpolationMode.BICUBIC):
+        """Resizes an image to a longer side of size, keeping its aspect ratio, into
+        the top left corner of a size x size uint8 canvas, so that images of any
+        shape can be batched. The fourth channel is 255 on the image and 0 on the
+        padding, and gives BatchAugmentation the box of every image.
+        Args:
+            size (int): side of the canvas
+            interpolation (InterpolationMode): interpolation of the resize
+        """
+        self.size = size
+        self.interpolation = interpolation
+
+    def __call__(self, img):
+        img = img.convert("RGB")
+        width, height = img.size
+        scale = self.size / max(width, height)
+        w, h = max(1, round(width * scale)), max(1, round(height * scale))
+        img = TF.resize(img, [h, w], interpolation=self.interpolation, antialias=True)
+        canvas = torch.zeros(4, self.size, self.size, dtype=torch.uint8)
+        canvas[:3, :h, :w] = TF.pil_to_tensor(img)
+        canvas[3, :h, :w] = 255
+        return canvas
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(size={self.size})"
+
+
+class BatchAugmentation:
+    def __init__(
+        self,
+        names,
+        standard_augmentation,
+        geometric_augmentation,
+        resize_size,
+        crop_size,
+        interpolation,
+        post,
+    ):
+        """Tensor backend of ImageAugmentation, applied to whole batches of
+        CanvasResize images.
+        Every augmentation of the PIL backend is replaced by a vectorized torch op
+        with the same probability and parameter ranges, drawn for each sample, which
+        are read from the PIL augmentations themselves. The ops work on the box of
+        every image in its canvas, so that rotations and random resized crops see the
+        whole image with its aspect ratio, as in the PIL backend, and the resize and
+        center crop of clip_transform are applied last. Pixel-sized parameters (blur
+        radius, sharpness kernel, noise) apply at the resolution of the canvas instead
+        of the resolution of the decoded image.
+        Args:
+            names (list): augmentations to apply, among "standard_augmentation" and
+                "geometric_augmentation", in order
+            standard_augmentation (StandardAugmentation): PIL photometric augmentations
+            geometric_augmentation (GeometricAugmentation): torchvision geometric
+                augmentations
+            resize_size (int): shorter side of the Resize of clip_transform
+            crop_size (tuple): size of the CenterCrop of clip_transform
+            interpolation (InterpolationMode): interpolation of clip_transform
+            post (Compose): transforms of the float batch in [0, 1], e.g. Normalize
+        """
+        self.resize_size = resize_size
+        self.crop_size = tuple(crop_size)
+        self.mode = grid_sample_mode(interpolation)
+        self.post = post
+        self.augmentations = []
+        for name in names:
+            if name == "standard_augmentation":
+                for op in standard_augmentation.names:
+                    self.augmentations.append(
+                        self.photometric(op, standard_augmentation.augmentations[op])
+                    )
+            elif name == "geometric_augmentation":
+                for op in geometric_augmentation.names:
+                    self.augmentations.append(
+                        self.geometric(geometric_augmentation.augmentations[op])
+                    )
+            else:
+                raise ValueError(f"No batch version of {name}")
+
+    def photometric(self, name, augmentation):
+        """Returns the batch op of a StandardAugmentation."""
+        if name in ["brightness", "contrast", "sharpness", "color"]:
+            degenerate = {
+                "brightness": lambda x, boxes: torch.zeros_like(x),
+                "contrast": lambda x, boxes: mean_luma(x, boxes),
+                "sharpness": lambda x, boxes: smooth(x, boxes),
+                "color": lambda x, boxes: grayscale(x),
+            }[name]
+            low, high = augmentation.factor_interval
+
+            def enhance(x, boxes):
+                # ImageEnhance blends the image with a degenerate version of itself
+                factor = uniform(low, high, len(x), x.device).view(-1, 1, 1, 1)
+                y = degenerate(x, boxes)
+                return (y + factor * (x - y)).clamp_(0, 1), boxes
+
+            return augmentation.p, enhance
+        if name == "blur":
+            # the radius of PillowBlur is drawn once, and is the std of the gaussian
+            sigma = float(augmentation.k)
+            return augmentation.p, lambda x, boxes: (
+                gaussian_blur(x, boxes, sigma),
+                boxes,
+            )
+        if name == "gaussian_noise":
+            noise_ratio = augmentation.noise_ratio
+
+            def noise(x, boxes):
+                sigma = uniform(0, noise_ratio, len(x), x.device).view(-1, 1, 1, 1)
+                return (x + sigma * torch.randn_like(x)).clamp_(0, 1), boxes
+
+            return augmentation.p, noise
+        raise ValueError(f"No batch version of the augmentation {name}")
+
+    def geometric(self, augmentation):
+        """Returns the batch op of a torchvision geometric augmentation."""
+        if isinstance(augmentation, (RandomHorizontalFlip, RandomVerticalFlip)):
+            horizontal = isinstance(augmentation, RandomHorizontalFlip)
+
+            def flip(x, boxes):
+                boxes = boxes.clone()
+                if horizontal:
+                    boxes[:, 0] = x.shape[-1] - boxes[:, 0] - boxes[:, 2]
+                else:
+                    boxes[:, 1] = x.shape[-2] - boxes[:, 1] - boxes[:, 3]
+                return x.flip(-1 if horizontal else -2), boxes
+
+            return augmentation.p, flip
+        if isinstance(augmentation, RandomRotation):
+            fill = augmentation.fill
+            fill = fill if isinstance(fill, (list, tuple)) else [fill]
+            if augmentation.expand or augmentation.center is not None or any(fill):
+                raise ValueError(
+                    f"Only zero-filled rotations are batched, got {augmentation}"
+                )
+            low, high = augmentation.degrees
+            mode = grid_sample_mode(augmentation.interpolation)
+
+            def rotate(x, boxes):
+                angle = torch.deg2rad(uniform(low, high, len(x), x.device))
+                cos, sin = torch.cos(angle), torch.sin(angle)
+                height, width = x.shape[-2:]
+                # counter-clockwise like TF.rotate, around the center of every box,
+                # in pixels from the center of the canvas
+                cx = boxes[:, 0] + boxes[:, 2] / 2 - width / 2
+                cy = boxes[:, 1] + boxes[:, 3] / 2 - height / 2
+                theta = torch.zeros(len(x), 2, 3, device=x.device)
+                theta[:, 0, 0], theta[:, 0, 1] = cos, -sin * height / width
+                theta[:, 1, 0], theta[:, 1, 1] = sin * width / height, cos
+                theta[:, 0, 2] = (cx - cos * cx + sin * cy) * 2 / width
+                theta[:, 1, 2] = (cy - sin * cx - cos * cy) * 2 / height
+                return warp(x, theta, x.shape[-2:], mode, "zeros"), boxes
+
+            return 1.0, rotate
+        if isinstance(augmentation, RandomResizedCrop):
+            mode = grid_sample_mode(augmentation.interpolation)
+
+            def resized_crop(x, boxes):
+                top, left, h, w = resized_crop_params(
+                    boxes, augmentation.scale, augmentation.ratio
+                )
+                theta = crop_theta(x, top, left, h, w)
+                x = warp(x, theta, augmentation.size, mode, "border")
+                return x, full_boxes(x)
+
+            return 1.0, resized_crop
+        raise ValueError(f"No batch version of the augmentation {augmentation}")
+
+    def center_crop(self, x, boxes):
+        """Resize of the shorter side of every box to resize_size and center crop to
+        crop_size, as clip_transform on the images of the PIL backend.
+        """
+        crop_height, crop_width = self.crop_size
+        if (
+            x.shape[-2:] == self.crop_size
+            and min(self.crop_size) == self.resize_size
+            and torch.equal(boxes, full_boxes(x))
+        ):
+            return x
+        left, top, width, height = boxes.unbind(1)
+        # size of an output pixel in pixels of the box
+        scale = torch.minimum(width, height) / self.resize_size
+        w = torch.minimum(crop_width * scale, width)
+        h = torch.minimum(crop_height * scale, height)
+        theta = crop_theta(x, top + (height - h) / 2, left + (width - w) / 2, h, w)
+        return warp(x, theta, self.crop_size, self.mode, "border")
+
+    @staticmethod
+    def apply(augmentation, x, boxes):
+        x, boxes = augmentation(x, boxes)
+        if not torch.equal(boxes, full_boxes(x)):
+            # the padding stays black, like the corners filled by rotations
+            x = x * box_mask(boxes, x.shape[-2:])
+        return x, boxes
+
+    def __call__(self, imgs):
+        """Augments a batch of B x 4 x H x W CanvasResize images (or of B x 3 x H x W
+        uint8 images filling their canvas) and returns the float batch.
+        """
+        x = imgs[:, :3].float().div_(255)
+        boxes = alpha_boxes(imgs[:, 3]) if imgs.shape[1] == 4 else full_boxes(x)
+        for p, augmentation in self.augmentations:
+            if p >= 1:
+                x, boxes = self.apply(augmentation, x, boxes)
+            else:
+                # same test as the PIL augmentations, random.random() <= p
+                selected = torch.rand(len(x), device=x.device) <= p
+                if selected.any():
+                    x[selected], boxes[selected] = self.apply(
+                        augmentation, x[selected], boxes[selected]
+                    )
+        return self.post(self.center_crop(x, boxes))
+
+
+def full_boxes(x):
+    """(left, top, width, height) boxes covering the whole of every image."""
+    height, width = x.shape[-2:]
+    boxes = torch.zeros(len(x), 4, device=x.device)
+    boxes[:, 2], boxes[:, 3] = width, height
+    return boxes
+
+
+def alpha_boxes(alpha):
+    """(left, top, width, height) boxes of the non-zero pixels of B x H x W masks."""
+    columns, rows = alpha.amax(dim=-2) > 0, alpha.amax(dim=-1) > 0
+    return torch.stack(
+        [
+            columns.int().argmax(-1),
+            rows.int().argmax(-1),
+            columns.sum(-1),
+            rows.sum(-1),
+        ],
+        dim=1,
+    ).float()
+
+
+def box_mask(boxes, size):
+    """B x 1 x H x W mask of the pixels inside the boxes."""
+    ys = torch.arange(size[0], device=boxes.device).view(1, -1, 1)
+    xs = torch.arange(size[1], device=boxes.device).view(1, 1, -1)
+    left, top, width, height = [b.view(-1, 1, 1) for b in boxes.unbind(1)]
+    inside = (xs >= left) & (xs < left + width) & (ys >= top) & (ys < top + height)
+    return inside.unsqueeze(1)
+
+
+def crop_theta(x, top, left, h, w):
+    """Affine grids sampling the (top, left, h, w) boxes of the batch."""
+    height, width = x.shape[-2:]
+    theta = torch.zeros(len(x), 2, 3, device=x.device)
+    theta[:, 0, 0], theta[:, 0, 2] = w / width, (2 * left + w) / width - 1
+    theta[:, 1, 1], theta[:, 1, 2] = h / height, (2 * top + h) / height - 1
+    return theta
+
+
+def uniform(low, high, n, device):
+    """n samples of U(low, high), with random.uniform semantics if high < low."""
+    return low + (high - low) * torch.rand(n, device=device)
+
+
+def grayscale(x):
+    """Luma of a float RGB batch as in PIL convert("L"), keeping 1 channel."""
+    return (0.299 * x[:, 0:1] + 0.587 * x[:, 1:2] + 0.114 * x[:, 2:3]).expand_as(x)
+
+
+def mean_luma(x, boxes):
+    """Mean luma of every image inside its box, the degenerate image of
+    ImageEnhance.Contrast."""
+    mask = box_mask(boxes, x.shape[-2:])
+    luma = grayscale(x)[:, :1] * mask
+    return (luma.sum(dim=(1, 2, 3)) / mask.sum(dim=(1, 2, 3))).view(-1, 1, 1, 1)
+
+
+def smooth(x, boxes):
+    """PIL ImageFilter.SMOOTH of a batch, the degenerate image of ImageEnhance.Sharpness."""
+    kernel = torch.ones(3, 3, dtype=x.dtype, device=x.device)
+    kernel[1, 1] = 5
+    kernel = (kernel / kernel.sum()).expand(x.shape[1], 1, 3, 3)
+    # the borders of the images are kept
+    shrink = torch.tensor([1, 1, -2, -2], dtype=boxes.dtype, device=boxes.device)
+    interior = box_mask(boxes + shrink, x.shape[-2:])
+    return torch.where(interior, F.conv2d(x, kernel, padding=1, groups=x.shape[1]), x)
+
+
+def gaussian_blur(x, boxes, sigma):
+    """Gaussian blur of a batch inside the boxes, with the weights of the pixels
+    outside renormalized like PIL extends the borders of the images.
+    """
+    radius = math.ceil(3 * sigma)
+    kernel = torch.arange(-radius, radius + 1, dtype=x.dtype, device=x.device)
+    kernel = torch.exp(-0.5 * (kernel / sigma) ** 2)
+    kernel = kernel / kernel.sum()
+    mask = box_mask(boxes, x.shape[-2:]).to(x.dtype)
+
+    def separable(y):
+        channels = y.shape[1]
+        horizontal = kernel.view(1, 1, 1, -1).expand(channels, 1, 1, -1)
+        vertical = kernel.view(1, 1, -1, 1).expand(channels, 1, -1, 1)
+        y = F.conv2d(y, horizontal, padding=(0, radius), groups=channels)
+        return F.conv2d(y, vertical, padding=(radius, 0), groups=channels)
+
+    return separable(x * mask) / separable(mask).clamp_(min=1e-6)
+
+
+def grid_sample_mode(interpolation):
+    """grid_sample mode of a torchvision InterpolationMode."""
+    modes = {
+        InterpolationMode.NEAREST: "nearest",
+        InterpolationMode.BILINEAR: "bilinear",
+        InterpolationMode.BICUBIC: "bicubic",
+    }
+    if interpolation not in modes:
+        raise ValueError(f"No batch version of the interpolation {interpolation}")
+    return modes[interpolation]
+
+
+def warp(x, theta, size, mode, padding_mode):
+    """Samples the batch on the affine grids theta (B x 2 x 3) of the given size."""
+    grid = F.affine_grid(theta, (len(x), x.shape[1], *size), align_corners=False)
+    return F.grid_sample(
+        x, grid, mode=mode, padding_mode=padding_mode, align_corners=False
+    )
+
+
+def resized_crop_params(boxes, scale, ratio, attempts=10):
+    """Vectorized RandomResizedCrop.get_params in the (left, top, width, height)
+    boxes of the images: (top, left, height, width) tensors, in the whole batch.
+    Like torchvision, the first of 10 random boxes that fits in the image is used,
+    with a center crop of the closest valid ratio when none fits.
+    """
+    n, device = len(boxes), boxes.device
+    box_left, box_top, width, height = boxes.unbind(1)
+    area = height * width
+    target_area = area * uniform(scale[0], scale[1], n * attempts, device).view(
+        attempts, n
+    )
+    log_ratio = uniform(math.log(ratio[0]), math.log(ratio[1]), n * attempts, device)
+    aspect_ratio = torch.exp(log_ratio).view(attempts, n)
+    w = torch.sqrt(target_area * aspect_ratio).round()
+    h = torch.sqrt(target_area / aspect_ratio).round()
+    fits = (w > 0) & (w <= width) & (h > 0) & (h <= height)
+    # first attempt that fits, or the fallback below
+    first = torch.where(fits.any(0), fits.int().argmax(0), -1)
+    in_ratio = width / height
+    fallback_w = torch.where(
+        in_ratio > max(ratio), torch.round(height * max(ratio)), width
+    )
+    fallback_h = torch.where(
+        in_ratio < min(ratio), torch.round(width / min(ratio)), height
+    )
+    index = first.clamp(min=0).unsqueeze(0)
+    w = torch.where(first >= 0, w.gather(0, index)[0], fallback_w)
+    h = torch.where(first >= 0, h.gather(0, index)[0], fallback_h)
+    top = torch.where(
+        first >= 0,
+        torch.floor(torch.rand(n, device=device) * (height - h + 1)),
+        torch.div(height - fallback_h, 2, rounding_mode="floor"),
+    )
+    left = torch.where(
+        first >= 0,
+        torch.floor(torch.rand(n, device=device) * (width - w + 1)),
+        torch.div(width - fallback_w, 2, rounding_mode="floor"),
+    )
+    return box_top + top, box_left + left, h, w
+
+
 class ImageAugmentation:
     def __init__(
-        self, names, clip_transform, standard_augmentation, geometric_augmentation
+        self,
+        names,
+        clip_transform,
+        standard_augmentation,
+        geometric_augmentation,
+        backend="pil",
+        pre_size=384,
     ):
+        """Augmentation of the training images.
+        Args:
+            names (str): comma-separated transforms to apply, in order, among
+                "standard_augmentation", "geometric_augmentation" and
+                "clip_transform", which must be last with the tensor backend
+            backend (str): "pil" to augment each image in the workers, or "tensor"
+                to only resize them to uint8 canvases of pre_size with CanvasResize,
+                and to augment the whole batch with batch_augmentation once it is on
+                its device, which applies the Resize and CenterCrop of
+                clip_transform last, as the PIL backend
+            pre_size (int): longer side of the images augmented by the tensor
+                backend, larger than the crop so that the geometric augmentations
+                sample from about the same pixels as with the PIL backend
+        """
         self.clip_transform = clip_transform
         self.standard_augmentation = standard_augmentation
         self.geometric_augmentation = geometric_augmentation
@@ -180,7 +679,44 @@ class ImageAugmentation:
             "standard_augmentation": self.standard_augmentation,
             "geometric_augmentation": self.geometric_augmentation,
         }
-        print(f"Image augmentation: {self.names}")
+        self.backend = backend
+        self.batch_augmentation = None
+        if backend == "tensor":
+            if self.names[-1] != "clip_transform":
+                raise ValueError("The tensor backend applies clip_transform last")
+            pre, post = split_transforms(clip_transform)
+            steps = pre.transforms[:-1]
+            if not (
+                len(steps) == 2
+                and isinstance(steps[0], Resize)
+                and isinstance(steps[1], CenterCrop)
+                and (isinstance(steps[0].size, int) or len(steps[0].size) == 1)
+            ):
+                raise ValueError(
+                    "The tensor backend needs a clip_transform resizing the shorter "
+                    f"side and center cropping, got {clip_transform}"
+                )
+            resize, crop = steps
+            resize_size = resize.size
+            if not isinstance(resize_size, int):
+                resize_size = resize_size[0]
+            self.names = ["clip_transform"]
+            self.transforms = {
+                "clip_transform": CanvasResize(pre_size, resize.interpolation)
+            }
+            # the batch is converted to float by BatchAugmentation
+            self.batch_augmentation = BatchAugmentation(
+                names.split(",")[:-1],
+                standard_augmentation,
+                geometric_augmentation,
+                resize_size,
+                crop.size,
+                resize.interpolation,
+                Compose(post.transforms[1:]),
+            )
+        elif backend != "pil":
+            raise ValueError(f"Unknown augmentation backend {backend}")
+        print(f"Image augmentation: {names.split(',')} ({backend} backend)")
 
     def __call__(self, img):
         for name in self.names:
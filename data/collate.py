@@ -0,0 +1,93 @@
+import numpy as np
+import torch
+from torch.utils.data import get_worker_info
+
+# keys gathered as python lists instead of being stacked
+LIST_KEYS = [
+    "idx",
+    "unique_country",
+    "unique_region",
+    "unique_sub-region",
+    "unique_city",
+    "img_idx",
+    "text",
+]
+
+
+class Collator:
+    def __init__(
+        self, list_keys=LIST_KEYS, density=False, pin_memory=False, aux_slices=None
+    ):
+        """Collates osv5m samples into a batch dictionary.
+        The schema of the batch (which keys are lists, stacked or dropped, and the
+        shape and dtype of the stacked tensors) is inferred once from the first
+        sample, and every stacked key is written into a single preallocated tensor.
+        Args:
+            list_keys (list): keys gathered as lists, e.g. the area names
+            density (bool): resample the batch with replacement proportionally to
+                the "weight" of the samples
+            pin_memory (bool): allocate the batch in pinned memory when collating in
+                the main process. Workers allocate it in shared memory instead, which
+                saves a copy when the batch is sent to the main process.
+            aux_slices (dict): columns of the packed "aux" targets of the samples,
+                the batched "aux" tensor is split into one view per auxiliary data
+        """
+        self.list_keys = list(list_keys)
+        self.density = density
+        self.pin_memory = pin_memory
+        self.aux_slices = aux_slices
+        self._schemas = {}
+
+    def with_aux_slices(self, aux_slices):
+        """Returns a copy of the collator splitting "aux" with the given slices."""
+        return Collator(self.list_keys, self.density, self.pin_memory, aux_slices)
+
+    def schema(self, sample):
+        """Returns the list keys and the (key, shape) of the stacked keys.
+        The schema is recomputed only when the keys or the shapes change, e.g. with
+        another image resolution.
+        """
+        keys = tuple(sample.keys())
+        if keys not in self._schemas or any(
+            sample[key].shape != shape for key, shape in self._schemas[keys][1]
+        ):
+            list_keys = [key for key in self.list_keys if key in sample]
+            tensor_keys = [
+                (key, tuple(sample[key].shape))
+                for key in keys
+                if key not in list_keys and key != "weight" and "text" not in key
+            ]
+            self._schemas[keys] = (list_keys, tensor_keys)
+        return self._schemas[keys]
+
+    def empty(self, elem, shape):
+        """Allocates an uninitialized batch tensor of the dtype and device of elem."""
+        if get_worker_info() is not None:
+            # as in torch default_collate, write directly into shared memory
+            storage = elem._typed_storage()._new_shared(
+                int(np.prod(shape)), device=elem.device
+            )
+            return elem.new(storage).resize_(*shape)
+        pin_memory = self.pin_memory and torch.cuda.is_available()
+        return torch.empty(shape, dtype=elem.dtype, pin_memory=pin_memory)
+
+    def __call__(self, batch):
+        if self.density:
+            weights = np.array([x["weight"] for x in batch])
+            normalized_weights = weights / np.sum(weights)
+            sampled_indices = np.random.choice(
+                len(batch), size=len(batch), p=normalized_weights, replace=True
+            )
+            batch = [batch[i] for i in sampled_indices]
+        list_keys, tensor_keys = self.schema(batch[0])
+        output = {key: [x[key] for x in batch] for key in list_keys}
+        for key, shape in tensor_keys:
+            output[key] = torch.stack(
+                [x[key] for x in batch],
+                out=self.empty(batch[0][key], (len(batch), *shape)),
+            )
+        if self.aux_slices is not None and "aux" in output:
+            aux = output.pop("aux")
+            for col, columns in self.aux_slices.items():
+                output[col] = aux[:, columns]
+        return output
@@ -1,9 +1,11 @@
+import io
+import hashlib
 import numpy as np
 import pandas as pd
 import torch
 import random
 
-from os.path import join
+from os.path import join, abspath
 from os.path import isfile
 from PIL import Image
 from sklearn.model_selection import train_test_split
@@ -16,8 +18,15 @@ from torchvision.transforms import (
     ToTensor,
 )
 import time
-from torchvision.transforms import GaussianBlur
-from torchvision import transforms
+from data.augmentation import BottomBlur
+from data.shards import ShardReader
+from data.image_index import ImageIndex
+from data.archives import ArchiveReader
+from data.image_cache import SharedImageCache, LocalFileCache
+from data.prefetch import Prefetcher
+from data.collate import Collator, LIST_KEYS
+from data.metadata import cached_csv
+from data.tensor_cache import TensorCache, split_transforms, tensor_cache_key
 
 def normalize(lat, lon):
     """Used to put all lat lon inside ±90 and ±180."""
@@ -29,186 +38,27 @@ def normalize(lat, lon):
     return lat, lon
 
 
-def collate_fn(batch):
-    """Collate function for the dataloader.
-    Args:
-        batch (list): list of dictionaries with keys "img", "gps", "idx" and optionally "label"
-    Returns:
-        dict: dictionary with keys "img", "gps", "idx" and optionally "label"
-    """
-    keys = list(batch[0].keys())
-    if "weight" in batch[0].keys():
-        keys.remove("weight")
-    output = {}
-    for key in [
-        "idx",
-        "unique_country",
-        "unique_region",
-        "unique_sub-region",
-        "unique_city",
-        "img_idx",
-        "text",
-    ]:
-        if key in keys:
-            idx = [x[key] for x in batch]
-            output[key] = idx
-            keys.remove(key)
-    for key in keys:
-        if not ("text" in key):
-            output[key] = torch.stack([x[key] for x in batch])
-    return output
-
-
-def collate_fn_streetclip(batch):
-    """Collate function for the dataloader.
-    Args:
-        batch (list): list of dictionaries with keys "img", "gps", "idx" and optionally "label"
-    Returns:
-        dict: dictionary with keys "img", "gps", "idx" and optionally "label"
-    """
-    keys = list(batch[0].keys())
-    if "weight" in batch[0].keys():
-        keys.remove("weight")
-    output = {}
-    for key in [
-        "idx",
-        "unique_country",
-        "unique_region",
-        "unique_sub-region",
-        "unique_city",
-        "img_idx",
-        "img",
-        "text",
-    ]:
-        if key in keys:
-            idx = [x[key] for x in batch]
-            output[key] = idx
-            keys.remove(key)
-    for key in keys:
-        if not ("text" in key):
-            output[key] = torch.stack([x[key] for x in batch])
-    return output
-
-
-def collate_fn_denstity(batch):
-    """Collate function for the dataloader.
-    Args:
-        batch (list): list of dictionaries with keys "img", "gps", "idx" and optionally "label"
-    Returns:
-        dict: dictionary with keys "img", "gps", "idx" and optionally "label"
-    """
-    keys = list(batch[0].keys())
-    if "weight" in batch[0].keys():
-        keys.remove("weight")
-    # Sample indices based on the weights
-    weights = np.array([x["weight"] for x in batch])
-    normalized_weights = weights / np.sum(weights)
-    sampled_indices = np.random.choice(
-        len(batch), size=len(batch), p=normalized_weights, replace=True
-    )
-    output = {}
-    for key in [
-        "idx",
-        "unique_country",
-        "unique_region",
-        "unique_sub-region",
-        "unique_city",
-        "img_idx",
-        "text",
-    ]:
-        if key in keys:
-            idx = [batch[i][key] for i in sampled_indices]
-            output[key] = idx
-            keys.remove(key)
-    for key in keys:
-        if not ("text" in key):
-            output[key] = torch.stack([batch[i][key] for i in sampled_indices])
-    return output
-
-
-def collate_fn_streetclip_denstity(batch):
-    """Collate function for the dataloader.
-    Args:
-        batch (list): list of dictionaries with keys "img", "gps", "idx" and optionally "label"
-    Returns:
-        dict: dictionary with keys "img", "gps", "idx" and optionally "label"
-    """
-    keys = list(batch[0].keys())
-    if "weight" in batch[0].keys():
-        keys.remove("weight")
-    # Sample indices based on the weights
-    weights = np.array([x["weight"] for x in batch])
-    normalized_weights = weights / np.sum(weights)
-    sampled_indices = np.random.choice(
-        len(batch), size=len(batch), p=normalized_weights, replace=True
-    )
-    output = {}
-    for key in [
-        "idx",
-        "unique_country",
-        "unique_region",
-        "unique_sub-region",
-        "unique_city",
-        "img_idx",
-        "img",
-        "text",
-    ]:
-        if key in keys:
-            idx = [batch[i][key] for i in sampled_indices]
-            output[key] = idx
-            keys.remove(key)
-    for key in keys:
-        if not ("text" in key):
-            output[key] = torch.stack([batch[i][key] for i in sampled_indices])
-    return output
-
-
-def collate_fn_contrastive(batch):
-    """Collate function for the dataloader.
-    Args:
-        batch (list): list of dictionaries with keys "img", "gps", "idx" and optionally "label"
-    Returns:
-        dict: dictionary with keys "img", "gps", "idx" and optionally "label"
-    """
-    output = collate_fn(batch)
-    pos_img = torch.stack([x["pos_img"] for x in batch])
-    output["pos_img"] = pos_img
-    return output
-
-
-def collate_fn_contrastive_density(batch):
-    """Collate function for the dataloader.
-    Args:
-        batch (list): list of dictionaries with keys "img", "gps", "idx" and optionally "label"
-    Returns:
-        dict: dictionary with keys "img", "gps", "idx" and optionally "label"
-    """
-    keys = list(batch[0].keys())
-    if "weight" in batch[0].keys():
-        keys.remove("weight")
-    # Sample indices based on the weights
-    weights = np.array([x["weight"] for x in batch])
-    normalized_weights = weights / np.sum(weights)
-    sampled_indices = np.random.choice(
-        len(batch), size=len(batch), p=normalized_weights, replace=True
-    )
-    output = {}
-    for key in [
-        "idx",
-        "unique_country",
-        "unique_region",
-        "unique_sub-region",
-        "unique_city",
-        "img_idx",
-    ]:
-        if key in keys:
-            idx = [batch[i][key] for i in sampled_indices]
-            output[key] = idx
-            keys.remove(key)
-    for key in keys:
-        if not ("text" in key):
-            output[key] = torch.stack([batch[i][key] for i in sampled_indices])
-    return output
+def normalize_gps(lat, lon):
+    """Vectorized normalize, returns (lat, lon) in radians as a float32 Nx2 array."""
+    lat = (lat + 90) % 360 - 90
+    flip = lat > 90
+    lat = np.where(flip, 180 - lat, lat)
+    lon = np.where(flip, lon + 180, lon)
+    lon = (lon + 180) % 360 - 180
+    return np.stack([np.radians(lat), np.radians(lon)], axis=1).astype(np.float32)
+
+
+# areas describing an image in TextContrastiveosv5m, from the most precise
+TEXT_AREAS = ["unique_city", "unique_sub-region", "unique_region", "unique_country"]
+
+collate_fn = Collator()
+collate_fn_streetclip = Collator(list_keys=LIST_KEYS + ["img"])
+collate_fn_denstity = Collator(density=True)
+collate_fn_streetclip_denstity = Collator(list_keys=LIST_KEYS + ["img"], density=True)
+collate_fn_contrastive = Collator()
+collate_fn_contrastive_density = Collator(
+    list_keys=[key for key in LIST_KEYS if key != "text"], density=True
+)
 
 
 class osv5m(Dataset):
@@ -225,7 +75,13 @@ class osv5m(Dataset):
         areas=["country", "region", "sub-region", "city"],
         streetclip=False,
         suff="",
-        blur=False
+        blur=False,
+        storage="folder",
+        draft_size=None,
+        tensor_cache=False,
+        shm_cache_gb=0,
+        local_cache_dir=None,
+        local_cache_gb=0,
     ):
         """Initializes the dataset.
         Args:
@@ -238,6 +94,20 @@ class osv5m(Dataset):
             streetclip (bool): if the model is streetclip, do not use transform
             suff (str): suffix of test csv
             blur (bool): blur bottom of images or not
+            storage (str): where images are read from, "folder" (one jpg per image),
+                "shards" (packed shards built by scripts/preprocessing/build-shards.py)
+                or "archives" (the downloaded zip or tar archives, not extracted)
+            draft_size (int): if set, jpgs are decoded at the smallest DCT scale whose
+                width and height are still at least draft_size, before transforms
+            tensor_cache (bool): read the resized and cropped images from the uint8
+                cache built by scripts/preprocessing/build-tensor-cache.py and only
+                apply the remaining transforms (e.g. normalization)
+            shm_cache_gb (float): budget of the jpg bytes cache shared in /dev/shm by
+                all the workers of a node, 0 to read every image from storage
+            local_cache_dir (str): directory on a local disk where the images, shards
+                or archives read from path are copied on their first access
+            local_cache_gb (float): budget of the local_cache_dir cache, 0 to read
+                every file from path
         """
         self.suff = suff
         self.path = path
@@ -256,27 +126,37 @@ class osv5m(Dataset):
             ("train" if split == "val" else split),
         )
 
-        self.dict_names = {}
-        for root, _, files in os.walk(self.image_folder):
-            for file in files:
-                self.dict_names[file] = os.path.join(root, file)
+        self.local_cache = None
+        if local_cache_gb > 0:
+            if local_cache_dir is None:
+                raise ValueError("local_cache_gb needs a local_cache_dir")
+            self.local_cache = LocalFileCache(path, local_cache_dir, local_cache_gb * 1e9)
+        self.storage = storage
+        if storage == "shards":
+            self.shards = ShardReader(
+                join(path, "shards", ("train" if split == "val" else split)),
+                local_cache=self.local_cache,
+            )
+        elif storage == "folder":
+            self.image_index = ImageIndex(
+                self.image_folder,
+                join(path, "cache", f"images_{'train' if split == 'val' else split}"),
+            )
+        elif storage == "archives":
+            self.archives = ArchiveReader(
+                self.image_folder,
+                join(path, "cache", f"archives_{'train' if split == 'val' else split}"),
+                local_cache=self.local_cache,
+            )
+        else:
+            raise ValueError(f"Unknown image storage {storage}")
+        self.image_cache = None
+        if shm_cache_gb > 0:
+            # one cache per image folder, whatever the storage it is read from
+            name = hashlib.sha1(abspath(self.image_folder).encode()).hexdigest()[:12]
+            self.image_cache = SharedImageCache(name, shm_cache_gb * 1e9)
 
         self.is_baseline = is_baseline
-        if self.aux:
-            self.aux_data = {}
-            for col in self.aux_list:
-                if col in ["land_cover", "climate", "soil"]:
-                    self.aux_data[col] = pd.get_dummies(self.df[col], dtype=float)
-                    if col == "climate":
-                        for i in range(31):
-                            if not (i in list(self.aux_data[col].columns)):
-                                self.aux_data[col][i] = 0
-                        desired_order = [i for i in range(31)]
-                        desired_order.remove(20)
-                        self.aux_data[col] = self.aux_data[col][desired_order]
-                else:
-                    self.aux_data[col] = self.df[col].apply(lambda x: [x])
-
         self.areas = ["_".join(["unique", area]) for area in areas]
         if class_name is None:
             self.class_name = class_name
@@ -284,94 +164,78 @@ class osv5m(Dataset):
             self.class_name = class_name
         else:
             self.class_name = "_".join(["unique", class_name])
+        full_df = self.df
         ex = self.extract_classes(self.class_name)
         self.df = self.df[
             ["id", "latitude", "longitude", "weight"] + self.areas + ex
         ].fillna("NaN")
         if self.class_name in self.areas:
             self.df.columns = list(self.df.columns)[:-1] + [self.class_name + "_2"]
+        self.build_arrays(full_df)
+        self.build_extra_arrays()
+        # the arrays hold everything read by __getitem__, and a DataFrame of Python
+        # objects would be copied into every worker on access
+        del self.df, full_df
         self.transforms = transforms
-        self.collate_fn = collate_fn
-        self.collate_fn_density = collate_fn_denstity
+        self.collate_fn = self.split_aux(collate_fn)
+        self.collate_fn_density = self.split_aux(collate_fn_denstity)
         self.blur = blur
+        self.bottom_blur = BottomBlur()
+        self.draft_size = draft_size
         self.streetclip = streetclip
         if self.streetclip:
-            self.collate_fn = collate_fn_streetclip
-            self.collate_fn_density = collate_fn_streetclip_denstity
+            self.collate_fn = self.split_aux(collate_fn_streetclip)
+            self.collate_fn_density = self.split_aux(collate_fn_streetclip_denstity)
+        # set by the datamodule, see __getitems__
+        self.prefetch_depth = 0
+        self.prefetcher = None
+        self._prefetched = None
+        self.tensor_cache = None
+        if tensor_cache:
+            if self.streetclip:
+                raise ValueError("The tensor cache cannot be used with streetclip")
+            pre_transforms, self.post_transforms = split_transforms(transforms)
+            self.tensor_cache = TensorCache(self.tensor_cache_path(pre_transforms))
+            self.tensor_rows = self.tensor_cache.rows(self.ids)
+
+    def split_aux(self, collate):
+        """Returns the collate function splitting the packed "aux" targets of the
+        samples into one batch tensor per auxiliary data.
+        """
+        if not self.aux:
+            return collate
+        return collate.with_aux_slices(self.aux_slices)
+
+    def tensor_cache_path(self, pre_transforms):
+        """Path prefix of the tensor cache of this split for the given transforms."""
+        key = tensor_cache_key(
+            pre_transforms, blur=self.blur, draft_size=self.draft_size
+        )
+        return join(self.path, "cache", f"tensors_{self.split}_{key}")
 
     def load_split(self, split):
         """Returns a new dataset with the given split."""
         start_time = time.time()
-        if split == "test":
-            df = pd.read_csv(join(self.path, "test.csv"), dtype=self.csv_dtype)
-            # extract coord
-            longitude = df["longitude"].values
-            latitude = df["latitude"].values
-            # Create bins
-            num_bins = 100
-            lon_bins = np.linspace(longitude.min(), longitude.max(), num_bins)
-            lat_bins = np.linspace(latitude.min(), latitude.max(), num_bins)
-            # compute density and weights
-            hist, _, _ = np.histogram2d(longitude, latitude, bins=[lon_bins, lat_bins])
-            weights = 1.0 / np.power(hist[df["lon_bin"], df["lat_bin"]], 0.75)
-            normalized_weights = weights / np.sum(weights)
-            df["weight"] = normalized_weights
-            return df
-        elif split == "select":
-            df = pd.read_csv(
-                join(self.path, "select.csv"), dtype=self.csv_dtype
-            )
-            # extract coord
-            longitude = df["longitude"].values
-            latitude = df["latitude"].values
-            # Create bins
-            num_bins = 100
-            lon_bins = np.linspace(longitude.min(), longitude.max(), num_bins)
-            lat_bins = np.linspace(latitude.min(), latitude.max(), num_bins)
-            # compute density and weights
-            hist, _, _ = np.histogram2d(longitude, latitude, bins=[lon_bins, lat_bins])
-            weights = 1.0 / np.power(hist[df["lon_bin"], df["lat_bin"]], 0.75)
-            normalized_weights = weights / np.sum(weights)
-            df["weight"] = normalized_weights
+        if split in ["test", "select"]:
+            metadata = cached_csv(join(self.path, f"{split}.csv"), self.csv_dtype)
+            df = metadata.read()
+            df["weight"] = metadata.density_weights()
             return df
+        if len(self.suff) == 0:
+            metadata = cached_csv(join(self.path, "train.csv"), self.csv_dtype)
         else:
-            if len(self.suff) == 0:
-                df = pd.read_csv(
-                    join(self.path, "train.csv"), dtype=self.csv_dtype
-                )
-            else:
-                df = pd.read_csv(
-                    join(self.path, "train" + "_" + self.suff + ".csv"),
-                    dtype=self.csv_dtype,
-                )
-
-        # extract coord
-        longitude = df["longitude"].values
-        latitude = df["latitude"].values
-        # Create bins
-        num_bins = 100
-        lon_bins = np.linspace(longitude.min(), longitude.max(), num_bins)
-        lat_bins = np.linspace(latitude.min(), latitude.max(), num_bins)
-        # compute density and weights
-        hist, _, _ = np.histogram2d(longitude, latitude, bins=[lon_bins, lat_bins])
-        weights = 1.0 / np.power(hist[df["lon_bin"], df["lat_bin"]], 0.75)
-        normalized_weights = weights / np.sum(weights)
-        df["weight"] = normalized_weights
-
-        test_df = df.sample(
-            n=int(0.1 * len(df)),
-            weights=normalized_weights,
-            replace=False,
-            random_state=42,
-        )
+            metadata = cached_csv(
+                join(self.path, "train" + "_" + self.suff + ".csv"), self.csv_dtype
+            )
+        # the val split is drawn once with the density weights and persisted
+        split_rows = metadata.train_val_split(val_proportion=0.1, seed=42)
+        rows = split_rows["val"] if split == "val" else split_rows["train"]
+        df = metadata.read(rows=rows)
+        df["weight"] = split_rows["weight"][rows]
 
         end_time = time.time()
         print(f"Loading {split} dataset took {(end_time - start_time):.2f} seconds")
-
-        if split == "val":
-            return test_df
-        else:
-            return df.drop(test_df.index)
+        return df
 
     def extract_classes(self, tag=None):
         """Extracts the categories from the dataset."""
@@ -382,17 +246,16 @@ class osv5m(Dataset):
         # splits = ["train", "test"]
         print(f"Loading categories from {splits}")
 
-        # concatenate all categories from relevant splits to find the unique ones.
+        # gather all categories from relevant splits to find the unique ones.
         self.categories = sorted(
-            pd.concat(
-                [
-                    pd.read_csv(join(self.path, f"{split}.csv"))[tag]
+            set().union(
+                *[
+                    cached_csv(
+                        join(self.path, f"{split}.csv"), self.csv_dtype
+                    ).vocabulary(tag)
                     for split in splits
                 ]
             )
-            .fillna("NaN")
-            .unique()
-            .tolist()
         )
 
         if "NaN" in self.categories:
@@ -409,6 +272,118 @@ class osv5m(Dataset):
         self.has_labels = True
         return [tag]
 
+    def area_vocabulary(self, area):
+        """Sorted names of an area level in the train and test splits, without NaN."""
+        names = set().union(
+            *[
+                cached_csv(join(self.path, f"{split}.csv"), self.csv_dtype).vocabulary(
+                    area
+                )
+                for split in ["train", "test"]
+            ]
+        )
+        names.discard("NaN")
+        return sorted(names)
+
+    def build_arrays(self, full_df):
+        """Converts the metadata to typed arrays so that __getitem__ is pure indexing.
+        Args:
+            full_df (pd.DataFrame): metadata before class filtering, with the aux columns
+        """
+        self.ids = self.df["id"].to_numpy(np.int64)
+        self.gps = normalize_gps(
+            self.df["latitude"].to_numpy(np.float64),
+            self.df["longitude"].to_numpy(np.float64),
+        )
+        self.weights = self.df["weight"].to_numpy(np.float32)
+        self.area_codes, self.area_names = {}, {}
+        self.area_ids, self.area_vocabularies = {}, {}
+        for area in self.areas:
+            codes, names = pd.factorize(self.df[area])
+            self.area_codes[area] = codes.astype(np.int32)
+            self.area_names[area] = np.asarray(names, dtype=object)
+            # ids into a vocabulary shared by all splits, -1 for NaN
+            self.area_vocabularies[area] = self.area_vocabulary(area)
+            self.area_ids[area] = pd.Categorical(
+                self.df[area], categories=self.area_vocabularies[area]
+            ).codes.astype(np.int32)
+        if self.has_labels:
+            self.labels = (
+                self.df.iloc[:, -1]
+                .map(self.category_to_index)
+                .fillna(-1)
+                .to_numpy(np.int32)
+            )
+        if self.aux:
+            # one-hot and scalar targets are packed in a single float32 matrix
+            blocks, self.aux_slices, start = [], {}, 0
+            for col in self.aux_list:
+                if col in ["land_cover", "climate", "soil"]:
+                    block = pd.get_dummies(full_df[col], dtype=float)
+                    if col == "climate":
+                        block = block.reindex(
+                            columns=[i for i in range(31) if i != 20], fill_value=0
+                        )
+                else:
+                    block = full_df[[col]]
+                blocks.append(block.loc[self.df.index].to_numpy(np.float32))
+                self.aux_slices[col] = slice(start, start + blocks[-1].shape[1])
+                start += blocks[-1].shape[1]
+            self.aux_matrix = np.ascontiguousarray(np.concatenate(blocks, axis=1))
+
+    def build_extra_arrays(self):
+        """Called once the arrays are built and before self.df is released, for
+        subclasses to derive their own per-sample arrays from the metadata.
+        """
+
+    def read_image(self, img_id):
+        """Returns the encoded bytes of an image, from the shared cache if enabled."""
+        if self.image_cache is not None:
+            data = self.image_cache.get(img_id)
+            if data is not None:
+                return data
+        if self.storage == "shards":
+            data = self.shards.read(img_id)
+        elif self.storage == "archives":
+            data = self.archives.read(f"{img_id}.jpg")
+        else:
+            with open(self.local_path(self.image_index.path(img_id)), "rb") as f:
+                data = f.read()
+        if self.image_cache is not None:
+            self.image_cache.put(img_id, data)
+        return data
+
+    def local_path(self, path):
+        """Returns the path of the local copy of a file of the dataset if the local
+        cache is enabled, the path itself otherwise.
+        """
+        if self.local_cache is None:
+            return path
+        return self.local_cache.path(path)
+
+    def fetch_image(self, img_id):
+        """Reads the bytes of an image into memory, run by the prefetch threads."""
+        return bytes(self.read_image(img_id))
+
+    def open_image(self, img_id, draft=False):
+        """Opens the image with the given id from the configured storage.
+        With draft, the jpg decoder is asked for a reduced-resolution image.
+        """
+        if self._prefetched is not None and self._prefetched[0] == img_id:
+            data, self._prefetched = self._prefetched[1], None
+        else:
+            data = self.read_image(img_id)
+        img = Image.open(io.BytesIO(data))
+        if draft and self.draft_size is not None:
+            img.draft(img.mode, (self.draft_size, self.draft_size))
+        return img
+
+    def load_image(self, img_id, image_transforms):
+        """Opens an image, blurs it if needed and applies the given transforms."""
+        if self.blur:
+            return image_transforms(self.bottom_blur(self.open_image(img_id)))
+        return image_transforms(self.open_image(img_id, draft=True))
+
     def __getitem__(self, i):
         """Returns an item from the dataset.
         Args:
@@ -416,51 +391,51 @@ class osv5m(Dataset):
         Returns:
             dict: dictionary with keys "img", "gps", "idx" and optionally "label"
         """
-        x = list(self.df.iloc[i])  # id, latitude, longitude, {category}
+        img_id = int(self.ids[i])
         if self.streetclip:
-            img = Image.open(self.dict_names[f"{int(x[0])}.jpg"])
-        elif self.blur:
-            img = transforms.ToTensor()(Image.open(self.dict_names[f"{int(x[0])}.jpg"]))
-            u = GaussianBlur(kernel_size = 13, sigma=2.0)
-            bottom_part = img[:, -14:, :].unsqueeze(0)
-            blurred_bottom = u(bottom_part)
-            img[:, -14:, :] = blurred_bottom.squeeze()
-            img = self.transforms(transforms.ToPILImage()(img))
+            img = self.open_image(img_id)
+        elif self.tensor_cache is not None:
+            img = self.post_transforms(self.tensor_cache[self.tensor_rows[i]])
         else:
-            img = self.transforms(
-                Image.open(self.dict_names[f"{int(x[0])}.jpg"])
-            )
-            
-        lat, lon = normalize(x[1], x[2])
-        gps = torch.FloatTensor([np.radians(lat), np.radians(lon)]).squeeze(0)
+            img = self.load_image(img_id, self.transforms)
 
         output = {
             "img": img,
-            "gps": gps,
+            "gps": torch.from_numpy(self.gps[i]),
             "idx": i,
-            "img_idx": int(x[0]),
-            "weight": x[3],
+            "img_idx": img_id,
+            "weight": float(self.weights[i]),
         }
 
-        for count, area in enumerate(self.areas):
-            output[area] = x[
-                count + 4
-            ]  #'country': x[3], 'region': x[4], 'sub-region': x[5], 'city': x[6]}
+        for area in self.areas:
+            output[area] = self.area_names[area][self.area_codes[area][i]]
+            output[f"{area}_id"] = torch.tensor(self.area_ids[area][i], dtype=torch.int32)
 
         if self.has_labels:
-            if x[-1] in self.categories:
-                output["label"] = torch.LongTensor(
-                    [self.category_to_index[x[-1]]]
-                ).squeeze(-1)
-            else:
-                output["label"] = torch.LongTensor([-1]).squeeze(-1)
+            output["label"] = torch.tensor(self.labels[i], dtype=torch.long)
         if self.aux:
-            for col in self.aux_list:
-                output[col] = torch.FloatTensor(self.aux_data[col].iloc[i])
+            # split into the aux_data targets by collate_fn, see split_aux
+            output["aux"] = torch.from_numpy(self.aux_matrix[i])
         return output
 
+    def __getitems__(self, indices):
+        """Returns the items of a batch, called by the DataLoader fetcher.
+        With prefetch_depth > 0, the bytes of the next prefetch_depth images are read
+        by a thread pool while the current ones are decoded and transformed.
+        """
+        if self.prefetch_depth == 0 or self.tensor_cache is not None:
+            return [self[i] for i in indices]
+        if self.prefetcher is None or self.prefetcher.depth != self.prefetch_depth:
+            self.prefetcher = Prefetcher(self.fetch_image, self.prefetch_depth)
+        img_ids = [int(self.ids[i]) for i in indices]
+        items = []
+        for i, img_id, data in zip(indices, img_ids, self.prefetcher(img_ids)):
+            self._prefetched = (img_id, data)
+            items.append(self[i])
+        return items
+
     def __len__(self):
-        return len(self.df)
+        return len(self.ids)
 
 
 class Contrastiveosv5m(osv5m):
@@ -473,10 +448,21 @@ class Contrastiveosv5m(osv5m):
         aux_data=[],
         class_name2=None,
         blur=False,
+        storage="folder",
+        draft_size=None,
+        tensor_cache=False,
+        shm_cache_gb=0,
+        local_cache_dir=None,
+        local_cache_gb=0,
+        in_batch_positives=False,
     ):
         """
         class_name2 (str): if not None, we do contrastive an other class than the one specified for classif
+        in_batch_positives (bool): do not load a positive image per sample, positives
+            are found inside the P x K batches of data.samplers.ClassBalancedSampler
         """
+        # read by build_extra_arrays, called by osv5m.__init__
+        self.class_name2 = class_name2
         super().__init__(
             path,
             transforms,
@@ -484,44 +470,66 @@ class Contrastiveosv5m(osv5m):
             class_name=class_name,
             aux_data=aux_data,
             blur=blur,
+            storage=storage,
+            draft_size=draft_size,
+            tensor_cache=tensor_cache,
+            shm_cache_gb=shm_cache_gb,
+            local_cache_dir=local_cache_dir,
+            local_cache_gb=local_cache_gb,
         )
+        self.in_batch_positives = in_batch_positives
+        if not in_batch_positives:
+            self.collate_fn = self.split_aux(collate_fn_contrastive)
+        self.random_crop = RandomCrop(224)  # use when no positive image is available
+        if getattr(self.transforms, "batch_augmentation", None) is not None:
+            # the canvases are cropped with the rest of the batch
+            self.random_crop = lambda img: img
+
+    def build_extra_arrays(self):
         self.add_label = False
-        if not(class_name2 is None) and split != 'test' and split != 'select':
+        if not(self.class_name2 is None) and self.split != 'test' and self.split != 'select':
             self.add_label = True
-            self.class_name = class_name2
-            self.extract_classes_contrastive(tag=class_name2)
+            self.class_name = self.class_name2
+            self.extract_classes_contrastive(tag=self.class_name2)
         self.df = self.df.reset_index(drop=True)
-        self.dict_classes = {
-            value: indices.tolist()
-            for value, indices in self.df.groupby(self.class_name).groups.items()
-        }
-        self.collate_fn = collate_fn_contrastive
-        self.random_crop = RandomCrop(224)  # use when no positive image is available
+        self.build_class_index()
+
+    def build_class_index(self):
+        """Groups the samples by contrastive class in a CSR structure:
+        class_members lists the sample indices sorted by class, the members of class c
+        being class_members[class_offsets[c]:class_offsets[c + 1]], and
+        member_positions gives the position of every sample in class_members.
+        """
+        codes, _ = pd.factorize(self.df[self.class_name])
+        self.class_codes = codes.astype(np.int64)
+        self.class_members = np.argsort(self.class_codes, kind="stable")
+        self.class_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(self.class_codes))]
+        )
+        self.member_positions = np.empty_like(self.class_members)
+        self.member_positions[self.class_members] = np.arange(len(self.class_members))
 
     def sample_positive(self, i):
         """
         sample positive image from the same city, country if it is available
         otherwise, apply different crop to the image
         """
-        x = self.df.iloc[i]  # id, latitude, longitude, {category}
-        class_name = x[self.class_name]
-        idxs = self.dict_classes[class_name]
-        idxs.remove(i)
-
-        if len(idxs) > 0:
-            idx = random.choice(idxs)
-            x = self.df.iloc[idx]
-            pos_img = self.transforms(
-                Image.open(self.dict_names[f"{int(x['id'])}.jpg"])
-            )
+        c = self.class_codes[i]
+        start, end = self.class_offsets[c], self.class_offsets[c + 1]
+
+        if end - start > 1:
+            # uniform draw among the other members of the class, skipping i
+            pos = start + random.randrange(end - start - 1)
+            if pos >= self.member_positions[i]:
+                pos += 1
+            idx = self.class_members[pos]
+            pos_img = self.transforms(self.open_image(int(self.ids[idx]), draft=True))
         else:
             pos_img = self.random_crop(
-                self.transforms(
-                    Image.open(self.dict_names[f"{int(x['id'])}.jpg"])
-                )
+                self.transforms(self.open_image(int(self.ids[i]), draft=True))
             )
         return pos_img
-    
+
     def extract_classes_contrastive(self, tag=None):
         """Extracts the categories from the dataset."""
         if tag is None:
@@ -531,32 +539,34 @@ class Contrastiveosv5m(osv5m):
         # splits = ["train", "test"]
         print(f"Loading categories from {splits}")
 
-        # concatenate all categories from relevant splits to find the unique ones.
+        # gather all categories from relevant splits to find the unique ones.
         categories = sorted(
-            pd.concat(
-                [
-                    pd.read_csv(join(self.path, f"{split}.csv"))[tag]
+            set().union(
+                *[
+                    cached_csv(
+                        join(self.path, f"{split}.csv"), self.csv_dtype
+                    ).vocabulary(tag)
                     for split in splits
                 ]
             )
-            .fillna("NaN")
-            .unique()
-            .tolist()
         )
         # create a mapping from category to index
         self.contrastive_category_to_index = {
             category: i for i, category in enumerate(categories)
         }
+        self.contrastive_labels = (
+            self.df[tag].map(self.contrastive_category_to_index).to_numpy(np.int64)
+        )
  
 
     def __getitem__(self, i):
         output = super().__getitem__(i)
-        pos_img = self.sample_positive(i)
-        output["pos_img"] = pos_img
+        if not self.in_batch_positives:
+            output["pos_img"] = self.sample_positive(i)
         if self.add_label:
-            output["label_contrastive"] = torch.LongTensor(
-                    [self.contrastive_category_to_index[self.df[self.class_name].iloc[i]]]
-                ).squeeze(-1)
+            output["label_contrastive"] = torch.tensor(
+                self.contrastive_labels[i], dtype=torch.long
+            )
         return output
 
 
@@ -569,6 +579,12 @@ class TextContrastiveosv5m(osv5m):
         class_name=None,
         aux_data=[],
         blur=False,
+        storage="folder",
+        draft_size=None,
+        tensor_cache=False,
+        shm_cache_gb=0,
+        local_cache_dir=None,
+        local_cache_gb=0,
     ):
         super().__init__(
             path,
@@ -577,24 +593,22 @@ class TextContrastiveosv5m(osv5m):
             class_name=class_name,
             aux_data=aux_data,
             blur=blur,
+            storage=storage,
+            draft_size=draft_size,
+            tensor_cache=tensor_cache,
+            shm_cache_gb=shm_cache_gb,
+            local_cache_dir=local_cache_dir,
+            local_cache_gb=local_cache_gb,
         )
+
+    def build_extra_arrays(self):
         self.df = self.df.reset_index(drop=True)
+        self.build_sentences()
 
-    def get_text(self, i):
-        """
-        sample positive image from the same city, country if it is available
-        otherwise, apply different crop to the image
-        """
-        x = self.df.iloc[i]  # id, latitude, longitude, {category}
-        l = [
-            name.split("_")[-1]
-            for name in [
-                x["unique_city"],
-                x["unique_sub-region"],
-                x["unique_region"],
-                x["unique_country"],
-            ]
-        ]
+    @staticmethod
+    def make_sentence(city, sub_region, region, country):
+        """Describes the location of an image from its unique_{area} names."""
+        l = [name.split("_")[-1] for name in [city, sub_region, region, country]]
 
         pre = False
         sentence = "An image of "
@@ -624,9 +638,42 @@ class TextContrastiveosv5m(osv5m):
 
         return sentence
 
+    def build_sentences(self):
+        """Builds the sentence of every distinct (city, sub-region, region, country)
+        of the train and test splits once, and the sentence id of every sample.
+        The ids are shared by all splits, so that the text encoder can tokenize
+        and embed every sentence once.
+        """
+        columns = TEXT_AREAS
+        tuples = (
+            pd.concat(
+                [
+                    cached_csv(join(self.path, f"{split}.csv"), self.csv_dtype).read(
+                        columns
+                    )
+                    for split in ["train", "test"]
+                ]
+            )
+            .fillna("NaN")
+            .drop_duplicates()
+            .sort_values(columns)
+        )
+        index = pd.MultiIndex.from_frame(tuples)
+        sample_tuples = pd.MultiIndex.from_frame(self.df[columns])
+        # tuples of other csvs (e.g. select.csv) go after the shared ones
+        extra = sample_tuples[index.get_indexer(sample_tuples) < 0].unique()
+        index = index.append(extra)
+        self.sentences = [self.make_sentence(*names) for names in index]
+        self.sentence_ids = index.get_indexer(sample_tuples).astype(np.int64)
+
+    def get_text(self, i):
+        """Returns the precomputed sentence describing the location of sample i."""
+        return self.sentences[self.sentence_ids[i]]
+
     def __getitem__(self, i):
         output = super().__getitem__(i)
         output["text"] = self.get_text(i)
+        output["sentence_id"] = torch.tensor(self.sentence_ids[i])
         return output
 
 
@@ -640,12 +687,21 @@ class Baseline(Dataset):
         path,
         which,
         transforms,
+        storage="folder",
+        local_cache_dir=None,
+        local_cache_gb=0,
     ):
         """Initializes the dataset.
         Args:
             path (str): path to the dataset
             which (str): which baseline to use (im2gps, im2gps3k)
             transforms (torchvision.transforms): transforms to apply to the images
+            storage (str): where images are read from, "folder" (the images folder)
+                or "archives" (images.zip, images.tar or the archives in images)
+            local_cache_dir (str): directory on a local disk where the images or
+                archives read from path are copied on their first access
+            local_cache_gb (float): budget of the local_cache_dir cache, 0 to read
+                every file from path
         """
         baselines = {
             "im2gps": self.load_im2gps,
@@ -653,6 +709,20 @@ class Baseline(Dataset):
             "yfcc4k": self.load_yfcc4k,
         }
         self.path = path
+        self.local_cache = None
+        if local_cache_gb > 0:
+            if local_cache_dir is None:
+                raise ValueError("local_cache_gb needs a local_cache_dir")
+            self.local_cache = LocalFileCache(path, local_cache_dir, local_cache_gb * 1e9)
+        self.storage = storage
+        if storage == "archives":
+            self.archives = ArchiveReader(
+                join(path, "images"),
+                join(path, "cache", "archives"),
+                local_cache=self.local_cache,
+            )
+        elif storage != "folder":
+            raise ValueError(f"Unknown image storage {storage} for {which}")
         self.samples = baselines[which]()
         self.transforms = transforms
         self.collate_fn = collate_fn
@@ -665,8 +735,12 @@ class Baseline(Dataset):
         with open(json_path) as f:
             data = json.load(f)
 
+        if self.storage == "archives":
+            names = [name.decode() for name in self.archives.names]
+        else:
+            names = os.listdir(join(self.path, "images"))
         samples = []
-        for f in os.listdir(join(self.path, "images")):
+        for f in names:
             if len(data[f]):
                 lat = float(data[f][-4].replace("latitude: ", ""))
                 lon = float(data[f][-3].replace("longitude: ", ""))
@@ -695,9 +769,14 @@ class Baseline(Dataset):
             dict: dictionary with keys "img", "gps", "idx" and optionally "label"
         """
         img_path, lat, lon = self.samples[i]
-        img = self.transforms(
-            Image.open(join(self.path, "images", img_path)).convert("RGB")
-        )
+        if self.storage == "archives":
+            img = Image.open(io.BytesIO(self.archives.read(img_path)))
+        else:
+            img_path = join(self.path, "images", img_path)
+            if self.local_cache is not None:
+                img_path = self.local_cache.path(img_path)
+            img = Image.open(img_path)
+        img = self.transforms(img.convert("RGB"))
         lat, lon = normalize(lat, lon)
         gps = torch.FloatTensor([np.radians(lat), np.radians(lon)]).squeeze(0)
 
@@ -3,6 +3,9 @@ from torch.utils.data import DataLoader, random_split
 import torch
 import time
 
+from data.augmentation import ProgressiveResize, find_transforms
+from data.samplers import DensityWeightedSampler, ClassBalancedSampler, ShuffleSampler
+
 
 class ImageDataModule(L.LightningDataModule):
     def __init__(
@@ -15,6 +18,14 @@ class ImageDataModule(L.LightningDataModule):
         num_nodes=1,
         num_devices=1,
         val_proportion=0.1,
+        density_sampler=True,
+        prefetch_depth=0,
+        samples_per_class=4,
+        sampler_seed=0,
+        prefetch_factor=2,
+        persistent_workers=False,
+        pin_memory=False,
+        resolution_schedule=None,
     ):
         super().__init__()
         self._builders = {
@@ -23,9 +34,37 @@ class ImageDataModule(L.LightningDataModule):
             "test": test_dataset,
         }
         self.num_workers = num_workers
+        # DataLoader options, see scripts/benchmarks/dataloader.py --autotune
+        self.prefetch_factor = prefetch_factor
+        self.persistent_workers = persistent_workers
+        self.pin_memory = pin_memory
+        # epoch -> train resolution, applied to the ProgressiveResize of the train
+        # transform, e.g. {0: 112, 3: 160, 6: 224}
+        self.resolution_schedule = None
+        if resolution_schedule is not None:
+            self.resolution_schedule = {
+                int(epoch): int(size) for epoch, size in resolution_schedule.items()
+            }
+            if persistent_workers:
+                # the workers are started again every epoch, from a train transform
+                # already at the resolution of the epoch
+                print("persistent_workers is disabled by the resolution_schedule")
+                self.persistent_workers = False
         self.batch_size = global_batch_size // (num_nodes * num_devices)
         print(f"Each GPU will receive {self.batch_size} images")
         self.val_proportion = val_proportion
+        # draw train samples by density weight in the sampler, before decoding,
+        # instead of resampling each decoded batch in collate_fn_density
+        self.density_sampler = density_sampler
+        # number of images read ahead by threads in each worker, see osv5m.__getitems__
+        self.prefetch_depth = prefetch_depth
+        # K of the P x K batches of datasets with in_batch_positives
+        self.samples_per_class = samples_per_class
+        # the train sampler and its position are saved in the checkpoints, so that
+        # training resumes in the middle of an epoch where it stopped
+        self.sampler_seed = sampler_seed
+        self.train_sampler = None
+        self._train_sampler_state = None
 
     @property
     def num_classes(self):
@@ -34,6 +73,22 @@ class ImageDataModule(L.LightningDataModule):
         else:
             return self._builders["train"]().num_classes
 
+    @property
+    def area_vocabularies(self):
+        """Vocabularies of the unique_{area} ids of the batches, None if not provided."""
+        for name in ["train_dataset", "test_dataset"]:
+            if hasattr(self, name):
+                return getattr(getattr(self, name), "area_vocabularies", None)
+        return None
+
+    @property
+    def text_sentences(self):
+        """Sentences indexed by the "sentence_id" of the batches, None if not provided."""
+        for name in ["train_dataset", "test_dataset"]:
+            if hasattr(self, name):
+                return getattr(getattr(self, name), "sentences", None)
+        return None
+
     def setup(self, stage=None):
         """Setup the datamodule.
         Args:
@@ -45,23 +100,105 @@ class ImageDataModule(L.LightningDataModule):
         if stage == "fit" or stage is None:
             self.train_dataset = self._builders["train"]()
             self.val_dataset = self._builders["val"]()
+            self.train_dataset.prefetch_depth = self.prefetch_depth
+            self.val_dataset.prefetch_depth = self.prefetch_depth
             print(f"Train dataset size: {len(self.train_dataset)}")
             print(f"Val dataset size: {len(self.val_dataset)}")
         else:
             self.test_dataset = self._builders["test"]()
+            self.test_dataset.prefetch_depth = self.prefetch_depth
             print(f"Test dataset size: {len(self.test_dataset)}")
         end_time = time.time()
         print(f"Setup took {(end_time - start_time):.2f} seconds")
 
+    def set_train_resolution(self, epoch):
+        """Sets the resolution of the train images for the given epoch, from the
+        resolution_schedule, and returns it.
+        Called when the train loader is created, since Lightning iterates it before
+        the first epoch starts, and at the start of every epoch by the module.
+        """
+        resolution = self.resolution_schedule[
+            max(e for e in self.resolution_schedule if e <= epoch)
+        ]
+        resizes = find_transforms(self.train_dataset.transforms, ProgressiveResize)
+        if len(resizes) == 0:
+            raise ValueError(
+                "A resolution_schedule needs a ProgressiveResize in the train "
+                "transform, e.g. dataset/train_transform=fast_clip_progressive"
+            )
+        for resize in resizes:
+            resize.set_size(resolution)
+        return resolution
+
+    def loader_options(self):
+        """Options shared by the DataLoaders, the worker ones only with workers."""
+        options = {"num_workers": self.num_workers, "pin_memory": self.pin_memory}
+        if self.num_workers > 0:
+            options["prefetch_factor"] = self.prefetch_factor
+            options["persistent_workers"] = self.persistent_workers
+        return options
+
+    def state_dict(self):
+        if self.train_sampler is None:
+            return {}
+        return {"train_sampler": self.train_sampler.state_dict()}
+
+    def load_state_dict(self, state_dict):
+        # applied to the train sampler when it is created, see train_dataloader
+        self._train_sampler_state = state_dict.get("train_sampler")
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        """Counts the train batches in the position of the train sampler, and
+        augments their images on their device when the train transform has a
+        batch_augmentation, see data.augmentation.ImageAugmentation.
+        """
+        if self.trainer is None or not self.trainer.training:
+            return batch
+        if self.train_sampler is not None:
+            self.train_sampler.advance(self.batch_size)
+        batch_augmentation = getattr(
+            self.train_dataset.transforms, "batch_augmentation", None
+        )
+        if batch_augmentation is not None:
+            for key in ["img", "pos_img"]:
+                if key in batch:
+                    batch[key] = batch_augmentation(batch[key])
+        return batch
+
     def train_dataloader(self):
+        if self.resolution_schedule is not None:
+            epoch = self.trainer.current_epoch if self.trainer is not None else 0
+            self.set_train_resolution(epoch)
+        if getattr(self.train_dataset, "in_batch_positives", False):
+            self.train_sampler = ClassBalancedSampler(
+                self.train_dataset.class_members,
+                self.train_dataset.class_offsets,
+                self.train_dataset.weights,
+                self.batch_size,
+                self.samples_per_class,
+                seed=self.sampler_seed,
+            )
+            collate_fn = self.train_dataset.collate_fn
+        elif self.density_sampler:
+            self.train_sampler = DensityWeightedSampler(
+                self.train_dataset.weights, seed=self.sampler_seed
+            )
+            collate_fn = self.train_dataset.collate_fn
+        else:
+            self.train_sampler = ShuffleSampler(
+                len(self.train_dataset), seed=self.sampler_seed
+            )
+            collate_fn = self.train_dataset.collate_fn_density
+        if self._train_sampler_state is not None:
+            self.train_sampler.load_state_dict(self._train_sampler_state)
+            self._train_sampler_state = None
         return DataLoader(
             self.train_dataset,
             batch_size=self.batch_size,
-            shuffle=True,
-            pin_memory=False,
+            sampler=self.train_sampler,
             drop_last=True,
-            num_workers=self.num_workers,
-            collate_fn=self.train_dataset.collate_fn_density,
+            collate_fn=collate_fn,
+            **self.loader_options(),
         )
 
     def val_dataloader(self):
@@ -69,9 +206,8 @@ class ImageDataModule(L.LightningDataModule):
             self.val_dataset,
             batch_size=self.batch_size,
             shuffle=False,
-            pin_memory=False,
-            num_workers=self.num_workers,
             collate_fn=self.val_dataset.collate_fn,
+            **self.loader_options(),
         )
 
     def test_dataloader(self):
@@ -79,7 +215,6 @@ class ImageDataModule(L.LightningDataModule):
             self.test_dataset,
             batch_size=self.batch_size,
             shuffle=False,
-            pin_memory=False,
-            num_workers=self.num_workers,
             collate_fn=self.test_dataset.collate_fn,
+            **self.loader_options(),
         )
@@ -0,0 +1,338 @@
+"""
+Node-wide cache of encoded image bytes in shared memory.
+
+Every DataLoader worker of every rank of a node reads and fills the same cache,
+stored as one file per image in a tmpfs directory (/dev/shm), so that hot images
+are read from RAM instead of the shared storage after their first access.
+The cache keeps its size under a byte budget by evicting the least recently used
+entries of a sample of randomly chosen buckets, and counts hits, misses and
+evictions in a small shared stats file. Each process accumulates its hits and misses and only takes the
+lock of the node to add them to the shared file every flush_every operations.
+
+LocalFileCache is the same kind of cache on a local disk, for whole files of a
+dataset on network storage: images of the folder storage, shards or archives are
+copied to the local directory on their first access and opened from there after.
+FileMaps memory-maps such files and releases the maps of evicted copies.
+"""
+
+import os
+import mmap
+import zlib
+import time
+import random
+import shutil
+import hashlib
+import threading
+import tempfile
+from os.path import join, isdir, relpath, abspath, getsize
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from data.utils import file_lock, try_file_lock
+
+STATS_FIELDS = ["bytes", "entries", "hits", "misses", "evictions"]
+
+# minimum number of entries whose recency is compared by an eviction
+EVICTION_SAMPLE = 64
+
+
+def default_cache_root():
+    return "/dev/shm" if isdir("/dev/shm") else tempfile.gettempdir()
+
+
+class SharedImageCache:
+    def __init__(
+        self, name, max_bytes, root=None, low_watermark=0.9, flush_every=256
+    ):
+        """Opens (or creates) the shared cache of the given name.
+        Args:
+            name (str): name of the cache, shared by all processes using it
+            max_bytes (int): budget of the cache in bytes
+            root (str): tmpfs directory holding the cache, defaults to /dev/shm
+            low_watermark (float): eviction frees space down to this budget fraction
+            flush_every (int): lookups counted by a process before it adds its
+                counts to the shared stats, also flushed every 10 seconds
+        """
+        self.directory = join(root or default_cache_root(), f"osv5m-{name}")
+        self.max_bytes = int(max_bytes)
+        self.low_watermark = low_watermark
+        self.flush_every = flush_every
+        self.lock_path = join(self.directory, "lock")
+        self.evict_lock_path = join(self.directory, "evict.lock")
+        self.stats_path = join(self.directory, "stats")
+        os.makedirs(self.directory, exist_ok=True)
+        with file_lock(self.lock_path):
+            if not os.path.isfile(self.stats_path):
+                np.zeros(len(STATS_FIELDS), dtype=np.int64).tofile(self.stats_path)
+        self._open_stats()
+
+    def _open_stats(self):
+        self._stats = np.memmap(
+            self.stats_path, dtype=np.int64, mode="r+", shape=(len(STATS_FIELDS),)
+        )
+        self._reset_pending()
+
+    def _reset_pending(self):
+        self._pid = os.getpid()
+        self._pending = np.zeros(len(STATS_FIELDS), dtype=np.int64)
+        self._pending_ops = 0
+        self._last_flush = time.monotonic()
+        self._pending_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ["_stats", "_pending", "_pending_lock"]:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open_stats()
+
+    def _path(self, key):
+        return join(self.directory, f"{key % 256:02x}", str(key))
+
+    def _add(self, flush=False, **counts):
+        """Counts in this process, and adds the counts to the shared stats once
+        enough operations or time have accumulated, or right away with flush.
+        """
+        if os.getpid() != self._pid:  # forked, the counts are the parent's
+            self._reset_pending()
+        with self._pending_lock:
+            for field, count in counts.items():
+                self._pending[STATS_FIELDS.index(field)] += count
+            self._pending_ops += 1
+            flush = (
+                flush
+                or self._pending_ops >= self.flush_every
+                or time.monotonic() - self._last_flush > 10
+            )
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """Adds the counts of this process to the shared stats, and evicts entries
+        if the cache is over budget.
+        """
+        if os.getpid() != self._pid:
+            self._reset_pending()
+        with self._pending_lock:
+            pending = self._pending.copy()
+            self._pending[:] = 0
+            self._pending_ops = 0
+            self._last_flush = time.monotonic()
+        with file_lock(self.lock_path):
+            self._stats[:] += pending
+            total = int(self._stats[0])
+        if total > self.max_bytes:
+            self._evict(total)
+
+    def get(self, key):
+        """Returns the bytes stored for an integer key, or None."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # mtime is the recency of the entry
+        except FileNotFoundError:  # never stored, or evicted
+            self._add(misses=1)
+            return None
+        self._add(hits=1)
+        return data
+
+    def put(self, key, data):
+        """Stores bytes for an integer key, unless already stored."""
+        if len(data) > self.max_bytes * (1 - self.low_watermark):
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # one tmp file per thread, the prefetch threads of a worker can store the
+        # same key at once
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        try:
+            os.link(tmp_path, path)  # fails if another worker stored it first
+        except (FileExistsError, FileNotFoundError):
+            return
+        finally:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+        # the byte count is shared right away, to evict as soon as it is needed
+        self._add(flush=True, bytes=len(data), entries=1)
+
+    def _evict(self, total):
+        """Removes the least recently used entries of random buckets until the cache
+        is back to its low watermark, in a single process at a time and without
+        holding the lock of the stats. Buckets are drawn until at least
+        EVICTION_SAMPLE entries are compared, so that a cache of a few big files
+        still evicts its oldest ones.
+        """
+        with try_file_lock(self.evict_lock_path) as acquired:
+            if not acquired:  # another process is evicting
+                return
+            buckets = [entry.path for entry in os.scandir(self.directory) if entry.is_dir()]
+            random.shuffle(buckets)
+            excess = total - self.low_watermark * self.max_bytes
+            freed, evicted = 0, 0
+            while freed < excess and len(buckets) > 0:
+                entries = []
+                while len(entries) < EVICTION_SAMPLE and len(buckets) > 0:
+                    entries += bucket_entries(buckets.pop())
+                entries.sort()
+                # the older half of the sample, an approximation of the global LRU
+                for _, size, path in entries[: max(1, len(entries) // 2)]:
+                    if freed >= excess:
+                        break
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        continue
+                    freed += size
+                    evicted += 1
+            with file_lock(self.lock_path):
+                self._stats[STATS_FIELDS.index("bytes")] -= freed
+                self._stats[STATS_FIELDS.index("entries")] -= evicted
+                self._stats[STATS_FIELDS.index("evictions")] += evicted
+
+    def stats(self):
+        """Returns the counters of the cache, shared by all of its processes. The
+        counts not flushed yet by other processes are missing.
+        """
+        self.flush()
+        stats = dict(zip(STATS_FIELDS, self._stats.tolist()))
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups > 0 else 0.0
+        return stats
+
+
+def bucket_entries(bucket):
+    """Lists the (mtime, size, path) of the entries of a bucket of a cache."""
+    entries = []
+    for folder, _, files in os.walk(bucket):
+        for file in files:
+            if not file.endswith(".tmp"):
+                path = join(folder, file)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+    return entries
+
+
+class LocalFileCache(SharedImageCache):
+    def __init__(self, remote_root, local_root, max_bytes, low_watermark=0.9):
+        """Read-through cache of the files of remote_root in a local directory,
+        shared by all the processes of a node.
+        Args:
+            remote_root (str): dataset directory, e.g. on a network filesystem
+            local_root (str): local directory holding the cache, e.g. on a local SSD
+            max_bytes (int): budget of the cache in bytes
+            low_watermark (float): eviction frees space down to this budget fraction
+        """
+        self.remote_root = abspath(remote_root)
+        name = hashlib.sha1(self.remote_root.encode()).hexdigest()[:12]
+        super().__init__(name, max_bytes, root=local_root, low_watermark=low_watermark)
+        self._skipped = set()
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["_skipped"] = set()
+        return state
+
+    def path(self, remote_path):
+        """Returns the path of the local copy of a file of remote_root, copying it
+        on a miss. Files outside of remote_root or bigger than the budget down to
+        its low watermark are not cached, and their remote path is returned.
+        """
+        rel_path = relpath(abspath(remote_path), self.remote_root)
+        if rel_path.startswith(os.pardir):
+            return remote_path
+        # spread over the buckets evicted by _evict, like the keys of the images
+        bucket = f"{zlib.crc32(rel_path.encode()) % 256:02x}"
+        path = join(self.directory, bucket, rel_path)
+        try:
+            os.utime(path)  # mtime is the recency of the entry
+            self._add(hits=1)
+            return path
+        except FileNotFoundError:  # never stored, or evicted
+            self._add(misses=1)
+        size = getsize(remote_path)
+        if size > self.max_bytes * self.low_watermark:
+            if remote_path not in self._skipped:
+                self._skipped.add(remote_path)
+                print(
+                    f"{remote_path} ({size / 1e9:.1f} GB) does not fit in the local "
+                    f"cache of {self.max_bytes / 1e9:.1f} GB, reading it from "
+                    f"{self.remote_root}"
+                )
+            return remote_path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copyfile(remote_path, tmp_path)
+        try:
+            os.link(tmp_path, path)  # fails if another worker stored it first
+        except FileExistsError:
+            return path
+        finally:
+            os.remove(tmp_path)
+        self._add(flush=True, bytes=size, entries=1)
+        return path
+
+    def warm_up(self, manifest, num_threads=16):
+        """Copies the files listed in a manifest, one path relative to remote_root
+        per line, in order, until the budget is filled up to its low watermark.
+        Returns:
+            int: number of files of the manifest in the cache
+        """
+        with open(manifest) as f:
+            rel_paths = [line.strip() for line in f if line.strip()]
+        budget = self.low_watermark * self.max_bytes
+        selected, total = [], 0
+        for rel_path in rel_paths:
+            size = getsize(join(self.remote_root, rel_path))
+            if total + size > budget:
+                break
+            selected.append(join(self.remote_root, rel_path))
+            total += size
+        with ThreadPoolExecutor(num_threads) as pool:
+            list(pool.map(self.path, selected))
+        return len(selected)
+
+
+class FileMaps:
+    def __init__(self, local_cache=None, check_every=10):
+        """Read-only memory maps of files, opened on their first access.
+        With a local cache, the files are mapped from their local copies, and the
+        maps are dropped every check_every seconds: the next access looks the file
+        up in the cache again, which refreshes its recency and copies it back if it
+        was evicted, and the map of an evicted copy no longer keeps it on disk once
+        the slices read from it are released.
+        Args:
+            local_cache (LocalFileCache): cache of the mapped files, or None
+            check_every (float): seconds between two lookups of a mapped file
+        """
+        self.local_cache = local_cache
+        self.check_every = check_every
+        self._maps = {}
+        self._checked = time.monotonic()
+
+    def __getitem__(self, path):
+        if self.local_cache is not None:
+            now = time.monotonic()
+            if now - self._checked > self.check_every:
+                # not closed, memoryviews of the maps may still be in use
+                self._maps = {}
+                self._checked = now
+        maps = self._maps
+        if path not in maps:
+            local_path = path
+            if self.local_cache is not None:
+                local_path = self.local_cache.path(path)
+            with open(local_path, "rb") as f:
+                maps[path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return maps[path]
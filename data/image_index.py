@@ -0,0 +1,105 @@
+"""
+Persistent index from image id to image path.
+
+Walking images/<split> and holding a Python dict of millions of paths in every
+process is slow and memory hungry. The index is built once, stored as a sorted
+structured numpy array next to a small manifest, and memory-mapped read-only by
+every rank and DataLoader worker.
+"""
+
+import os
+import json
+import hashlib
+from os.path import join, dirname, relpath
+
+import numpy as np
+
+from data.utils import save_array_atomic, save_json_atomic, file_lock
+
+
+def walk_images(image_folder):
+    """Lists (id, path relative to image_folder) of every jpg image, sorted by id."""
+    images = []
+    for root, _, files in os.walk(image_folder):
+        for file in files:
+            stem, ext = os.path.splitext(file)
+            if ext.lower() == ".jpg" and stem.isdigit():
+                images.append((int(stem), relpath(join(root, file), image_folder)))
+    return sorted(images)
+
+
+def folder_signature(image_folder):
+    """Cheap signature of an image folder from the mtimes of its first two levels.
+    Adding or removing an image changes the mtime of its parent directory.
+    """
+    entries = [(".", os.stat(image_folder).st_mtime_ns)]
+    for entry in sorted(os.scandir(image_folder), key=lambda e: e.name):
+        if entry.is_dir():
+            entries.append((entry.name, entry.stat().st_mtime_ns))
+    return hashlib.sha1(json.dumps(entries).encode()).hexdigest()
+
+
+class ImageIndex:
+    def __init__(self, image_folder, index_path):
+        """Loads the index of image_folder from index_path, building it if needed.
+        Args:
+            image_folder (str): folder containing the images, possibly in subfolders
+            index_path (str): path prefix of the index files (.npy and .json)
+        """
+        self.image_folder = image_folder
+        self.index_path = index_path
+        if not self.is_valid():
+            self.build()
+        self._load_index()
+
+    def is_valid(self):
+        try:
+            with open(f"{self.index_path}.json") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return manifest.get("signature") == folder_signature(self.image_folder)
+
+    def build(self):
+        """Walks the image folder and persists the index, once across processes."""
+        os.makedirs(dirname(self.index_path), exist_ok=True)
+        with file_lock(f"{self.index_path}.lock"):
+            if self.is_valid():  # built by another rank while we were waiting
+                return
+            signature = folder_signature(self.image_folder)
+            print(f"Indexing images of {self.image_folder}")
+            images = walk_images(self.image_folder)
+            max_len = max([len(path) for _, path in images], default=1)
+            index = np.empty(
+                len(images), dtype=[("id", "<i8"), ("path", f"S{max_len}")]
+            )
+            index["id"] = [image_id for image_id, _ in images]
+            index["path"] = [path.encode() for _, path in images]
+            save_array_atomic(f"{self.index_path}.npy", index)
+            save_json_atomic(
+                f"{self.index_path}.json",
+                {"signature": signature, "num_images": len(images)},
+            )
+
+    def _load_index(self):
+        self.index = np.load(f"{self.index_path}.npy", mmap_mode="r")
+        self.ids = self.index["id"]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["index"], state["ids"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load_index()
+
+    def __len__(self):
+        return len(self.index)
+
+    def path(self, image_id):
+        """Returns the full path of the image with the given id."""
+        pos = np.searchsorted(self.ids, image_id)
+        if pos >= len(self.ids) or self.ids[pos] != image_id:
+            raise KeyError(f"Image {image_id} not found in {self.image_folder}")
+        return join(self.image_folder, self.index[pos]["path"].decode())
@@ -0,0 +1,219 @@
+"""
+Binary cache of the metadata csv files.
+
+Each csv is parsed once and stored as a columnar .npz next to the dataset:
+numeric columns are stored as is (with their unique values if integer), other
+columns as int32 codes into a small sorted array of categories, so that the
+vocabulary of a column is available without scanning it.
+A cache is invalidated when the size or the mtime of its source csv changes.
+"""
+
+import os
+import json
+from os.path import join, dirname, basename
+
+import numpy as np
+import pandas as pd
+
+from data.utils import file_lock
+
+CACHE_VERSION = 1
+
+
+def csv_signature(csv_path, dtype=None):
+    stat = os.stat(csv_path)
+    return {
+        "version": CACHE_VERSION,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "dtype": repr(sorted((dtype or {}).items())),
+    }
+
+
+def density_weights(longitude, latitude, lon_bin, lat_bin, num_bins=100):
+    """Normalized inverse density weights of the samples on a lon/lat grid."""
+    lon_bins = np.linspace(longitude.min(), longitude.max(), num_bins)
+    lat_bins = np.linspace(latitude.min(), latitude.max(), num_bins)
+    hist, _, _ = np.histogram2d(longitude, latitude, bins=[lon_bins, lat_bins])
+    weights = 1.0 / np.power(hist[lon_bin, lat_bin], 0.75)
+    return weights / np.sum(weights)
+
+
+class CachedCSV:
+    def __init__(self, csv_path, dtype=None, cache_dir=None):
+        """Columnar binary cache of a csv file, built on first use.
+        Args:
+            csv_path (str): path to the csv file
+            dtype (dict): dtype argument of pd.read_csv
+            cache_dir (str): where to store the cache, defaults to <csv dir>/cache
+        """
+        self.csv_path = csv_path
+        self.dtype = dtype
+        cache_dir = cache_dir or join(dirname(csv_path), "cache")
+        self.cache_path = join(cache_dir, basename(csv_path) + ".npz")
+        self.signature = csv_signature(csv_path, dtype)
+        if not self.is_valid():
+            self.build()
+        self.data = np.load(self.cache_path, allow_pickle=True)
+        self.meta = json.loads(str(self.data["__meta__"]))
+        self.columns = self.meta["columns"]
+        self._vocabularies = {}
+
+    def is_valid(self):
+        try:
+            with np.load(self.cache_path) as data:
+                meta = json.loads(str(data["__meta__"]))
+        except (OSError, ValueError, KeyError):
+            return False
+        return meta["signature"] == self.signature
+
+    def build(self):
+        os.makedirs(dirname(self.cache_path), exist_ok=True)
+        with file_lock(self.cache_path + ".lock"):
+            if self.is_valid():  # built by another rank while we were waiting
+                return
+            print(f"Caching {self.csv_path} to {self.cache_path}")
+            df = pd.read_csv(self.csv_path, dtype=self.dtype, low_memory=False)
+            arrays, kinds = {}, {}
+            for k, col in enumerate(df.columns):
+                if pd.api.types.is_numeric_dtype(df[col]):
+                    kinds[col] = "numeric"
+                    arrays[f"{k}.values"] = df[col].to_numpy()
+                    if pd.api.types.is_integer_dtype(df[col]):
+                        arrays[f"{k}.unique"] = np.unique(arrays[f"{k}.values"])
+                else:
+                    kinds[col] = "categorical"
+                    try:
+                        codes, categories = pd.factorize(df[col], sort=True)
+                    except TypeError:  # mixed types cannot be sorted
+                        codes, categories = pd.factorize(df[col])
+                    arrays[f"{k}.codes"] = codes.astype(np.int32)
+                    arrays[f"{k}.categories"] = np.asarray(categories, dtype=object)
+            meta = {
+                "signature": self.signature,
+                "columns": list(df.columns),
+                "kinds": kinds,
+                "num_rows": len(df),
+            }
+            tmp_path = f"{self.cache_path}.{os.getpid()}.tmp.npz"
+            np.savez(tmp_path, __meta__=np.array(json.dumps(meta)), **arrays)
+            os.replace(tmp_path, self.cache_path)
+
+    def __len__(self):
+        return self.meta["num_rows"]
+
+    def column(self, col, rows=None):
+        """Returns a column as a numpy array, optionally restricted to some rows."""
+        k = self.columns.index(col)
+        if self.meta["kinds"][col] == "numeric":
+            values = self.data[f"{k}.values"]
+            return values if rows is None else values[rows]
+        codes = self.data[f"{k}.codes"]
+        if rows is not None:
+            codes = codes[rows]
+        # code -1 (missing value) maps to the appended NaN
+        categories = np.append(self.data[f"{k}.categories"], np.nan)
+        return categories[codes]
+
+    def read(self, columns=None, rows=None):
+        """Returns the csv as a DataFrame, as pd.read_csv would.
+        Args:
+            columns (list): columns to load, all by default
+            rows (np.ndarray): positions of the rows to load, all by default.
+                The index of the DataFrame keeps the original row positions.
+        """
+        columns = self.columns if columns is None else columns
+        index = pd.RangeIndex(len(self)) if rows is None else pd.Index(rows)
+        return pd.DataFrame(
+            {col: self.column(col, rows) for col in columns}, index=index
+        )
+
+    def density_weights(self):
+        return density_weights(
+            self.column("longitude"),
+            self.column("latitude"),
+            self.column("lon_bin"),
+            self.column("lat_bin"),
+        )
+
+    def train_val_split(self, val_proportion=0.1, seed=42):
+        """Splits the rows in train and val, drawing val with the density weights.
+        The split is computed once and persisted next to the cache.
+        Returns:
+            dict: "weight" of every row, "train" and "val" row positions
+        """
+        split_path = self.cache_path.replace(
+            ".npz", f".split_{val_proportion}_{seed}.npz"
+        )
+        signature = json.dumps(self.signature)
+        split = self._load_split(split_path, signature)
+        if split is not None:
+            return split
+        with file_lock(split_path + ".lock"):
+            split = self._load_split(split_path, signature)
+            if split is not None:  # written by another rank while we were waiting
+                return split
+            weights = self.density_weights()
+            # same draw as DataFrame.sample, which only depends on the weights
+            val = (
+                pd.Series(np.arange(len(self)))
+                .sample(
+                    n=int(val_proportion * len(self)),
+                    weights=weights,
+                    replace=False,
+                    random_state=seed,
+                )
+                .to_numpy()
+            )
+            is_val = np.zeros(len(self), dtype=bool)
+            is_val[val] = True
+            split = {"weight": weights, "train": np.flatnonzero(~is_val), "val": val}
+            tmp_path = f"{split_path}.{os.getpid()}.tmp.npz"
+            np.savez(tmp_path, signature=np.array(signature), **split)
+            os.replace(tmp_path, split_path)
+        return split
+
+    @staticmethod
+    def _load_split(split_path, signature):
+        """Returns the persisted split if it matches the signature, else None."""
+        try:
+            with np.load(split_path) as data:
+                if str(data["signature"]) == signature:
+                    return {k: data[k] for k in ["weight", "train", "val"]}
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def vocabulary(self, col):
+        """Returns the unique values of a column, missing values being "NaN"."""
+        if col not in self._vocabularies:
+            k = self.columns.index(col)
+            if f"{k}.unique" in self.data:
+                vocabulary = self.data[f"{k}.unique"].tolist()
+                missing = np.zeros(0, dtype=bool)
+            elif self.meta["kinds"][col] == "numeric":
+                values = self.data[f"{k}.values"]
+                missing = pd.isna(values)
+                vocabulary = np.unique(values[~missing]).tolist()
+            else:
+                vocabulary = self.data[f"{k}.categories"].tolist()
+                missing = self.data[f"{k}.codes"] < 0
+            if missing.any():
+                vocabulary.append("NaN")
+            self._vocabularies[col] = vocabulary
+        return self._vocabularies[col]
+
+
+_cached_csvs = {}
+
+
+def cached_csv(csv_path, dtype=None):
+    """Returns the CachedCSV of a csv file, shared within the process."""
+    key = (csv_path, repr(sorted((dtype or {}).items())))
+    if key in _cached_csvs and _cached_csvs[key].signature != csv_signature(
+        csv_path, dtype
+    ):
+        del _cached_csvs[key]
+    if key not in _cached_csvs:
+        _cached_csvs[key] = CachedCSV(csv_path, dtype)
+    return _cached_csvs[key]
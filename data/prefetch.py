@@ -0,0 +1,55 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetcher:
+    def __init__(self, read, depth):
+        """Reads keys ahead of their use from a small thread pool, so that storage
+        latency overlaps with the decoding of the previous samples.
+        The pool is created lazily, so the prefetcher can be sent to workers.
+        Args:
+            read (callable): function reading the data of a key, released by the GIL
+                while waiting for the storage
+            depth (int): maximum number of reads in flight
+        """
+        self.read = read
+        self.depth = depth
+        self._pool = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        return state
+
+    def __call__(self, keys):
+        """Yields the data of every key, in order, with up to depth reads ahead.
+        A key repeated within the reads ahead (e.g. drawn twice by a sampler with
+        replacement) is read once.
+        """
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self.depth, thread_name_prefix="prefetch")
+        keys = iter(keys)
+        pending = deque()
+        in_flight = {}  # key -> [future, number of pending uses]
+
+        def submit(key):
+            if key not in in_flight:
+                in_flight[key] = [self._pool.submit(self.read, key), 0]
+            in_flight[key][1] += 1
+            pending.append(key)
+
+        for key in keys:
+            submit(key)
+            if len(pending) >= self.depth:
+                break
+        while pending:
+            key = pending.popleft()
+            entry = in_flight[key]
+            data = entry[0].result()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del in_flight[key]
+            for key in keys:
+                submit(key)
+                break
+            yield data
@@ -0,0 +1,212 @@
+import math
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data.distributed import DistributedSampler
+
+
+def distributed_context(num_replicas=None, rank=None):
+    """Returns (num_replicas, rank), defaulting to the current process group."""
+    initialized = dist.is_available() and dist.is_initialized()
+    if num_replicas is None:
+        num_replicas = dist.get_world_size() if initialized else 1
+    if rank is None:
+        rank = dist.get_rank() if initialized else 0
+    return num_replicas, rank
+
+
+class ResumableSampler(DistributedSampler):
+    """Base of the train samplers: a seeded global stream of indices per epoch, dealt
+    to the ranks in blocks, which can be resumed at any position of the epoch.
+    The position is counted in samples of the global stream, so that a checkpoint
+    saved with some number of ranks is resumed with any other: the remaining part
+    of the stream is dealt to the new ranks.
+    Subclasses implement global_indices, and set block_size, num_samples and
+    total_size after calling __init__.
+    """
+
+    block_size = 1
+
+    def __init__(self, dataset, num_replicas=None, rank=None, seed=0):
+        num_replicas, rank = distributed_context(num_replicas, rank)
+        super().__init__(
+            dataset, num_replicas=num_replicas, rank=rank, shuffle=True, seed=seed
+        )
+        # samples of the global stream consumed in position_epoch, see advance
+        self.position_epoch = 0
+        self.position = 0
+
+    def global_indices(self, size):
+        """Returns the first size indices of the global stream of the epoch.
+        Streams of different sizes must share their prefix.
+        """
+        raise NotImplementedError
+
+    def start(self):
+        """Position of the global stream where the current epoch starts."""
+        return self.position if self.position_epoch == self.epoch else 0
+
+    def advance(self, num_samples):
+        """Records that every rank consumed num_samples samples of the epoch."""
+        if self.position_epoch != self.epoch:
+            self.position_epoch, self.position = self.epoch, 0
+        self.position += num_samples * self.num_replicas
+
+    def state_dict(self):
+        return {
+            "seed": self.seed,
+            "epoch": self.position_epoch,
+            "position": self.position,
+        }
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict["seed"]
+        self.position_epoch = state_dict["epoch"]
+        self.position = state_dict["position"]
+        # Lightning iterates the loader of the resumed epoch before setting the epoch
+        # of its sampler, which the workers would otherwise start drawing at epoch 0
+        finished = self.position >= self.total_size
+        self.set_epoch(self.position_epoch + 1 if finished else self.position_epoch)
+
+    def __iter__(self):
+        start = self.start()
+        stride = self.block_size * self.num_replicas
+        num_blocks = max(math.ceil((self.total_size - start) / stride), 0)
+        blocks = self.global_indices(start + num_blocks * stride)[start:]
+        blocks = blocks.reshape(-1, self.block_size)
+        return iter(blocks[self.rank :: self.num_replicas].ravel().tolist())
+
+    def __len__(self):
+        # the full epoch, which Lightning expects when resuming in its middle
+        return self.num_samples
+
+
+class ShuffleSampler(ResumableSampler):
+    def __init__(self, size, num_replicas=None, rank=None, seed=0):
+        """Draws a seeded permutation of the dataset at each epoch.
+        Args:
+            size (int): number of samples of the dataset
+            num_replicas (int): number of ranks, defaults to the world size
+            rank (int): rank of the current process
+            seed (int): seed shared by all ranks, offset by the epoch
+        """
+        super().__init__(range(size), num_replicas=num_replicas, rank=rank, seed=seed)
+        self.size = size
+
+    def global_indices(self, size):
+        # padded by repeating the permutation, as in DistributedSampler
+        rng = np.random.default_rng(self.seed + self.epoch)
+        return np.resize(rng.permutation(self.size), size)
+
+
+class DensityWeightedSampler(ResumableSampler):
+    def __init__(self, weights, num_replicas=None, rank=None, seed=0):
+        """Draws indices with replacement proportionally to the density weights.
+        Every rank draws the same global sequence for a given epoch and keeps its
+        own slice, so the samples are chosen before any image is read.
+        Subclassing DistributedSampler keeps Lightning from wrapping it.
+        Args:
+            weights (np.ndarray): weight of every sample of the dataset
+            num_replicas (int): number of ranks, defaults to the world size
+            rank (int): rank of the current process
+            seed (int): seed shared by all ranks, offset by the epoch
+        """
+        super().__init__(weights, num_replicas=num_replicas, rank=rank, seed=seed)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.weights = self.weights / self.weights.sum()
+        self.cdf = np.cumsum(self.weights)
+        self.cdf /= self.cdf[-1]
+        self.num_samples = math.ceil(len(self.weights) / self.num_replicas)
+        self.total_size = self.num_samples * self.num_replicas
+
+    def global_indices(self, size):
+        # what rng.choice(p=weights) draws, written out so that its prefix is stable
+        rng = np.random.default_rng(self.seed + self.epoch)
+        return np.searchsorted(self.cdf, rng.random(size), side="right")
+
+
+class ClassBalancedSampler(ResumableSampler):
+    def __init__(
+        self,
+        class_members,
+        class_offsets,
+        weights,
+        batch_size,
+        samples_per_class,
+        num_replicas=None,
+        rank=None,
+        seed=0,
+    ):
+        """Builds every batch from P classes x K samples, so that each sample has
+        K - 1 positives of its class inside the batch.
+        Classes are drawn proportionally to the sum of the density weights of their
+        samples, and samples within a class proportionally to their weight, so the
+        samples follow the same distribution as with DensityWeightedSampler.
+        Batches are dealt to the ranks in turn; the DataLoader must use the same
+        batch_size with drop_last so that its batches match the P x K blocks, and
+        resuming with another number of ranks keeps the blocks whole as long as the
+        new batch size is also a multiple of samples_per_class.
+        Args:
+            class_members (np.ndarray): sample indices sorted by class
+            class_offsets (np.ndarray): members of class c are
+                class_members[class_offsets[c]:class_offsets[c + 1]]
+            weights (np.ndarray): weight of every sample of the dataset
+            batch_size (int): per rank batch size, a multiple of samples_per_class
+            samples_per_class (int): K, the number of samples drawn per class
+            num_replicas (int): number of ranks, defaults to the world size
+            rank (int): rank of the current process
+            seed (int): seed shared by all ranks, offset by the epoch
+        """
+        if batch_size % samples_per_class != 0:
+            raise ValueError(
+                f"The batch size {batch_size} is not a multiple of "
+                f"samples_per_class={samples_per_class}"
+            )
+        super().__init__(weights, num_replicas=num_replicas, rank=rank, seed=seed)
+        self.block_size = batch_size
+        self.class_members = class_members
+        self.class_offsets = class_offsets
+        self.batch_size = batch_size
+        self.samples_per_class = samples_per_class
+        self.classes_per_batch = batch_size // samples_per_class
+        # cumulative weights of the members, for O(log n) draws within a class
+        self.cumulative_weights = np.cumsum(
+            np.asarray(weights, dtype=np.float64)[class_members]
+        )
+        self.weight_offsets = np.concatenate([[0.0], self.cumulative_weights])[
+            class_offsets
+        ]
+        self.class_weights = np.diff(self.weight_offsets)
+        # a class needs two members to provide a positive
+        self.class_weights[np.diff(class_offsets) < 2] = 0
+        if self.class_weights.sum() <= 0:
+            raise ValueError("No class has at least two samples")
+        self.class_weights /= self.class_weights.sum()
+        self.num_batches = math.ceil(len(weights) / (batch_size * self.num_replicas))
+        self.num_samples = self.num_batches * batch_size
+        self.total_size = self.num_samples * self.num_replicas
+
+    def global_indices(self, size):
+        # classes and members are drawn from two generators, so that the stream of
+        # P x K blocks has the same prefix whatever its size
+        class_rng, member_rng = [
+            np.random.default_rng([self.seed, self.epoch, stream]) for stream in [0, 1]
+        ]
+        classes = class_rng.choice(
+            len(self.class_weights),
+            size=size // self.samples_per_class,
+            p=self.class_weights,
+        )
+        classes = np.repeat(classes, self.samples_per_class)
+        positions = np.searchsorted(
+            self.cumulative_weights,
+            member_rng.uniform(
+                self.weight_offsets[classes], self.weight_offsets[classes + 1]
+            ),
+            side="right",
+        )
+        # rounding can land on a neighbouring class, clip to the drawn class
+        positions = np.clip(
+            positions, self.class_offsets[classes], self.class_offsets[classes + 1] - 1
+        )
+        return self.class_members[positions]
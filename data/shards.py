@@ -0,0 +1,145 @@
+"""
+Packed shard storage for image bytes.
+
+A shard directory contains append-only blob files ``<name>.bin``, one partial
+index ``<name>.idx.npy`` per blob (written when the blob is sealed), and a merged
+``index.npy`` sorted by image id together with ``shards.txt`` listing the blob
+names in the order referenced by the index.
+"""
+
+import os
+from glob import glob
+from os.path import join, basename
+
+import numpy as np
+
+from data.image_cache import FileMaps
+from data.utils import save_array_atomic
+
+SHARD_INDEX_DTYPE = np.dtype(
+    [("id", "<i8"), ("shard", "<i4"), ("offset", "<i8"), ("length", "<i8")]
+)
+PARTIAL_INDEX_DTYPE = np.dtype([("id", "<i8"), ("offset", "<i8"), ("length", "<i8")])
+
+
+class ShardWriter:
+    def __init__(self, root, name):
+        """Writes image bytes sequentially into a single shard file.
+        Args:
+            root (str): directory containing the shards
+            name (str): name of the shard, without extension
+        """
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.name = name
+        self.file = open(join(root, f"{name}.bin"), "wb")
+        self.entries = []
+        self.offset = 0
+
+    def write(self, image_id, data):
+        """Appends the encoded bytes of an image to the shard."""
+        self.file.write(data)
+        self.entries.append((int(image_id), self.offset, len(data)))
+        self.offset += len(data)
+
+    def close(self):
+        """Flushes the shard and seals it by writing its partial index."""
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        index = np.array(self.entries, dtype=PARTIAL_INDEX_DTYPE)
+        save_array_atomic(join(self.root, f"{self.name}.idx.npy"), index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def merge_shard_indexes(root):
+    """Merges the partial index of every sealed shard of root into index.npy.
+    Returns:
+        int: number of images in the merged index
+    """
+    partial_paths = sorted(glob(join(root, "*.idx.npy")))
+    names = [basename(p)[: -len(".idx.npy")] for p in partial_paths]
+    parts = []
+    for shard, partial_path in enumerate(partial_paths):
+        partial = np.load(partial_path)
+        part = np.empty(len(partial), dtype=SHARD_INDEX_DTYPE)
+        for field in PARTIAL_INDEX_DTYPE.names:
+            part[field] = partial[field]
+        part["shard"] = shard
+        parts.append(part)
+    index = np.concatenate(parts) if parts else np.empty(0, SHARD_INDEX_DTYPE)
+    index = index[np.argsort(index["id"], kind="stable")]
+    duplicated = index["id"][1:][index["id"][1:] == index["id"][:-1]]
+    if len(duplicated) > 0:
+        raise ValueError(f"Image {duplicated[0]} is stored in several shards of {root}")
+    tmp_path = join(root, f"shards.txt.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(names))
+    os.replace(tmp_path, join(root, "shards.txt"))
+    save_array_atomic(join(root, "index.npy"), index)
+    return len(index)
+
+
+class ShardReader:
+    def __init__(self, root, local_cache=None):
+        """Serves image bytes from packed shards through memory-mapped slices.
+        The index and the shards are mapped lazily in each process, so the reader
+        can be shared with DataLoader workers and between ranks.
+        Args:
+            root (str): directory containing index.npy, shards.txt and the shards
+            local_cache (data.image_cache.LocalFileCache): if set, the shards are
+                copied to a local disk on their first access and mapped from there,
+                see data.image_cache.FileMaps
+        """
+        self.root = root
+        self.local_cache = local_cache
+        with open(join(root, "shards.txt")) as f:
+            self.shard_names = f.read().split()
+        self._load_index()
+
+    def _load_index(self):
+        self.index = np.load(join(self.root, "index.npy"), mmap_mode="r")
+        self.ids = self.index["id"]
+        self._maps = FileMaps(self.local_cache)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ["index", "ids", "_maps"]:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load_index()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, image_id):
+        pos = np.searchsorted(self.ids, image_id)
+        return pos < len(self.ids) and self.ids[pos] == image_id
+
+    def shard_path(self, shard):
+        return join(self.root, f"{self.shard_names[shard]}.bin")
+
+    def _map(self, shard):
+        return self._maps[self.shard_path(shard)]
+
+    def locate(self, image_id):
+        """Returns the (shard, offset, length) of an image."""
+        pos = np.searchsorted(self.ids, image_id)
+        if pos >= len(self.ids) or self.ids[pos] != image_id:
+            raise KeyError(f"Image {image_id} not found in shards at {self.root}")
+        entry = self.index[pos]
+        return int(entry["shard"]), int(entry["offset"]), int(entry["length"])
+
+    def read(self, image_id):
+        """Returns the encoded bytes of an image as a memoryview into its shard."""
+        shard, offset, length = self.locate(image_id)
+        return memoryview(self._map(shard))[offset : offset + length]
@@ -0,0 +1,146 @@
+"""
+Pre-resized uint8 image cache for deterministic evaluation transforms.
+
+Test transforms such as fast_clip resize and crop every image the same way at
+each evaluation. Their deterministic part (everything before ToTensor) is run
+once per split and its uint8 output is stored in a single memory-mapped
+N x C x H x W array, next to the sorted image ids it holds. Datasets then only
+convert the cached tensors to float and normalize them.
+"""
+
+import os
+import json
+import hashlib
+from os.path import isfile
+
+import numpy as np
+import torch
+from torchvision.transforms import (
+    Compose,
+    Resize,
+    CenterCrop,
+    ToTensor,
+    PILToTensor,
+    ConvertImageDtype,
+)
+
+from data.utils import save_json_atomic
+
+CACHEABLE_TRANSFORMS = (Resize, CenterCrop)
+
+
+def split_transforms(transforms, name=None):
+    """Splits a Compose at its ToTensor into a cacheable and a float part.
+    ToTensor is replaced by PILToTensor followed by ConvertImageDtype, which
+    gives exactly the same values. The steps before ToTensor must be Resize and
+    CenterCrop, the last one giving images of a fixed size, so that the cache is
+    a single N x C x H x W array.
+    Args:
+        transforms (Compose): test transforms
+        name (str): name of their config in configs/dataset/test_transform, for
+            the error message
+    Returns:
+        (Compose, Compose): transforms from PIL image to uint8 tensor, and from
+            uint8 tensor to the final float tensor
+    """
+    steps = transforms.transforms if isinstance(transforms, Compose) else []
+    k = next((k for k, t in enumerate(steps) if isinstance(t, ToTensor)), None)
+    if (
+        k is None
+        or k == 0
+        or not all(isinstance(t, CACHEABLE_TRANSFORMS) for t in steps[:k])
+        or not has_fixed_size(steps[k - 1])
+    ):
+        config = f"test_transform={name}" if name is not None else f"{transforms}"
+        raise ValueError(
+            "tensor_cache needs a test_transform resizing and cropping the images to "
+            "a fixed size with Resize and CenterCrop before ToTensor, such as "
+            f"test_transform=fast_clip, got {config}"
+        )
+    return (
+        Compose(steps[:k] + [PILToTensor()]),
+        Compose([ConvertImageDtype(torch.float32)] + steps[k + 1 :]),
+    )
+
+
+def has_fixed_size(transform):
+    """Whether a Resize or CenterCrop outputs images of the same size for any input,
+    unlike a Resize of the shorter side only.
+    """
+    if isinstance(transform, CenterCrop):
+        return True
+    size = transform.size
+    return isinstance(size, (list, tuple)) and len(size) == 2
+
+
+def tensor_cache_key(pre_transforms, **options):
+    """Hash of everything that changes the cached pixels."""
+    description = repr(pre_transforms) + json.dumps(options, sort_keys=True)
+    return hashlib.sha1(description.encode()).hexdigest()[:12]
+
+
+class TensorCache:
+    def __init__(self, cache_path):
+        """Memory-mapped uint8 images, looked up by image id.
+        Args:
+            cache_path (str): path prefix of the cache files (.npy, .ids.npy, .json)
+        """
+        self.cache_path = cache_path
+        if not self.is_built():
+            raise FileNotFoundError(
+                f"No tensor cache at {cache_path}, "
+                "build it with scripts/preprocessing/build-tensor-cache.py"
+            )
+        self._load()
+
+    def is_built(self):
+        return isfile(f"{self.cache_path}.json")
+
+    @staticmethod
+    def create(cache_path, num_images, shape):
+        """Allocates the array of a new cache, to be filled before calling seal."""
+        if isfile(f"{cache_path}.json"):  # unseal a cache being rebuilt
+            os.remove(f"{cache_path}.json")
+        return np.lib.format.open_memmap(
+            f"{cache_path}.npy", mode="w+", dtype=np.uint8, shape=(num_images, *shape)
+        )
+
+    @staticmethod
+    def seal(cache_path, ids, **manifest):
+        """Marks a filled cache as complete, storing the image id of every row."""
+        np.save(f"{cache_path}.ids.npy", np.asarray(ids, dtype=np.int64))
+        save_json_atomic(f"{cache_path}.json", {"num_images": len(ids), **manifest})
+
+    def _load(self):
+        self.array = np.load(f"{self.cache_path}.npy", mmap_mode="r")
+        ids = np.load(f"{self.cache_path}.ids.npy")
+        self.order = np.argsort(ids, kind="stable")
+        self.sorted_ids = ids[self.order]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["array"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.array = np.load(f"{self.cache_path}.npy", mmap_mode="r")
+
+    def __len__(self):
+        return len(self.array)
+
+    def rows(self, ids):
+        """Returns the rows of the cache holding the given image ids."""
+        ids = np.asarray(ids, dtype=np.int64)
+        pos = np.searchsorted(self.sorted_ids, ids)
+        found = pos < len(self.sorted_ids)
+        found[found] = self.sorted_ids[pos[found]] == ids[found]
+        if not found.all():
+            raise KeyError(
+                f"{(~found).sum()} images, e.g. {ids[~found][0]}, "
+                f"are not in the tensor cache {self.cache_path}"
+            )
+        return self.order[pos]
+
+    def __getitem__(self, row):
+        return torch.from_numpy(np.array(self.array[row]))
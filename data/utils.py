@@ -0,0 +1,49 @@
+import os
+import json
+import fcntl
+from contextlib import contextmanager
+
+import numpy as np
+
+
+def save_array_atomic(path, array):
+    """Saves a numpy array so that concurrent readers never see a partial file."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def save_json_atomic(path, data):
+    """Saves a json file so that concurrent readers never see a partial file."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def file_lock(path):
+    """Exclusive lock shared by all the processes of a node (and of the cluster on
+    filesystems supporting flock), used to build cached files only once."""
+    with open(path, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+@contextmanager
+def try_file_lock(path):
+    """Like file_lock without waiting: yields whether the lock was acquired."""
+    with open(path, "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
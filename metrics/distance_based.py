@@ -1,6 +1,6 @@
 import torch
 
-from metrics.utils import haversine, reverse
+from metrics.utils import haversine, reverse, reverse_geocode, area_names
 
 from torchmetrics import Metric
 
@@ -44,6 +44,7 @@ class HaversineMetrics(Metric):
         self.acc_radius = acc_radiuses
         self.acc_area = acc_area
         self.add_state("count", default=torch.tensor(0), dist_reduce_fx="sum")
+        self.area_to_id = None
         self.aux = len(aux_data) > 0
         self.aux_list = aux_data
         if self.aux:
@@ -55,19 +56,55 @@ class HaversineMetrics(Metric):
                     dist_reduce_fx="sum",
                 )
 
+    def set_area_vocabularies(self, vocabularies):
+        """Enables the comparison of predicted areas with the unique_{area}_id of the
+        batches instead of their names.
+        Args:
+            vocabularies (dict): names of every unique_{area} id
+        """
+        self.area_to_id = {
+            area[len("unique_") :]: {name: i for i, name in enumerate(names)}
+            for area, names in vocabularies.items()
+        }
+
+    def uses_area_ids(self, gt):
+        return (
+            self.area_to_id is not None
+            and "continent" not in self.acc_area
+            and all(f"unique_{acc}_id" in gt for acc in self.acc_area)
+        )
+
     def update(self, pred, gt):
         haversine_distance = haversine(pred["gps"], gt["gps"])
         for acc in self.acc_radius:
             self.__dict__[f"close_enough_points_{acc}"] += (
                 haversine_distance < acc
             ).sum()
-        if len(self.acc_area) > 0:
+        if len(self.acc_area) > 0 and self.uses_area_ids(gt):
+            location = reverse_geocode(pred["gps"])
+            for acc in self.acc_area:
+                gt_ids = gt[f"unique_{acc}_id"]
+                # -2 for predicted names outside of the vocabulary, -1 is NaN
+                pred_ids = torch.tensor(
+                    [
+                        self.area_to_id[acc].get(name, -2)
+                        for name in area_names(location, acc)
+                    ],
+                    device=gt_ids.device,
+                )
+                self.__dict__[f"close_enough_points_{acc}"] += (
+                    pred_ids == gt_ids
+                ).sum()
+                self.__dict__[f"count_{acc}"] += len(gt_ids)
+        elif len(self.acc_area) > 0:
             area_pred, area_gt = reverse(pred["gps"], gt, self.acc_area)
-        for acc in self.acc_area:
-            self.__dict__[f"close_enough_points_{acc}"] += (
-                area_pred[acc] == area_gt["_".join(["unique", acc])]
-            ).sum()
-            self.__dict__[f"count_{acc}"] += len(area_gt["_".join(["unique", acc])])
+            for acc in self.acc_area:
+                self.__dict__[f"close_enough_points_{acc}"] += (
+                    area_pred[acc] == area_gt["_".join(["unique", acc])]
+                ).sum()
+                self.__dict__[f"count_{acc}"] += len(
+                    area_gt["_".join(["unique", acc])]
+                )
         self.haversine_sum += haversine_distance.sum()
         self.geoguessr_sum += 5000 * torch.exp(-haversine_distance / 1492.7).sum()
 
@@ -23,6 +23,33 @@ def haversine(pred, gt):
     return distance
 
 
+AREA_KEYS = {
+    "country": ["cc"],
+    "region": ["admin1", "cc"],
+    "sub-region": ["admin2", "admin1", "cc"],
+    "city": ["name", "admin2", "admin1", "cc"],
+}
+
+
+def reverse_geocode(pred):
+    """Reverse geocodes (lat, lon) predictions in radians."""
+    return reverse_geocoder.search(
+        [
+            (lat, lon)
+            for lat, lon in zip(
+                np.degrees(pred[:, 0].cpu()), np.degrees(pred[:, 1].cpu())
+            )
+        ]
+    )
+
+
+def area_names(location, area):
+    """Names of an area of geocoded points, formatted as the unique_{area} columns."""
+    return np.array(
+        ["_".join([l.get(key, "") for key in AREA_KEYS[area]]) for l in location]
+    )
+
+
 def reverse(pred, gt, area):
     df = {}
     gt_area = {}
@@ -34,52 +61,17 @@ def reverse(pred, gt, area):
         inter = np.array(gt[ar])
         nan_mask[ar] = inter != "nan"
         gt_area[ar] = inter[nan_mask[ar]]
-    location = reverse_geocoder.search(
-        [
-            (lat, lon)
-            for lat, lon in zip(
-                np.degrees(pred[:, 0].cpu()), np.degrees(pred[:, 1].cpu())
-            )
-        ]
-    )
+    location = reverse_geocode(pred)
     if "continent" in area:
         continent = torch.load("continent.pt")
-        inter = np.array([l.get("cc", "") for l in location])[
-            nan_mask["unique_country"]
-        ]
+        inter = area_names(location, "country")[nan_mask["unique_country"]]
         df["continent"] = np.array([continent[i] for i in inter])
         gt_area["unique_continent"] = np.array(
             [continent[i] for i in gt_area["unique_country"]]
         )
 
-    if "country" in area:
-        df["country"] = np.array([l.get("cc", "") for l in location])[
-            nan_mask["unique_country"]
-        ]
-    if "region" in area:
-        df["region"] = np.array(
-            ["_".join([l.get("admin1", ""), l.get("cc", "")]) for l in location]
-        )[nan_mask["unique_region"]]
-    if "sub-region" in area:
-        df["sub-region"] = np.array(
-            [
-                "_".join([l.get("admin2", ""), l.get("admin1", ""), l.get("cc", "")])
-                for l in location
-            ]
-        )[nan_mask["unique_sub-region"]]
-    if "city" in area:
-        df["city"] = np.array(
-            [
-                "_".join(
-                    [
-                        l.get("name", ""),
-                        l.get("admin2", ""),
-                        l.get("admin1", ""),
-                        l.get("cc", ""),
-                    ]
-                )
-                for l in location
-            ]
-        )[nan_mask["unique_city"]]
+    for ar in ["country", "region", "sub-region", "city"]:
+        if ar in area:
+            df[ar] = area_names(location, ar)[nan_mask[f"unique_{ar}"]]
 
     return df, gt_area
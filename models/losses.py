@@ -117,6 +117,36 @@ class HierarchicalCrossEntropy(nn.Module):
         self.country_to_idx = torch.load(path + "country_to_idx.pt")
         self.region_to_idx = torch.load(path + "region_to_idx.pt")
         self.area_to_idx = torch.load(path + "area_to_idx.pt")
+        self.id_to_idx = None
+
+    def set_area_vocabularies(self, vocabularies):
+        """Maps the unique_{area}_id of the batches to the indices of the hierarchy,
+        names missing from the hierarchy being ignored by the losses.
+        Args:
+            vocabularies (dict): names of every unique_{area} id
+        """
+        self.id_to_idx = {
+            area: torch.tensor(
+                [to_idx.get(name, -100) for name in vocabularies[area]],
+                dtype=torch.long,
+            )
+            for area, to_idx in [
+                ("unique_country", self.country_to_idx),
+                ("unique_region", self.region_to_idx),
+                ("unique_sub-region", self.area_to_idx),
+            ]
+        }
+
+    def targets(self, y, area, to_idx, device):
+        """Returns the mask of the samples with a known area and their targets."""
+        if self.id_to_idx is not None and f"{area}_id" in y:
+            ids = y[f"{area}_id"]
+            mask = ids >= 0
+            self.id_to_idx[area] = self.id_to_idx[area].to(device)
+            return mask, self.id_to_idx[area][ids[mask].long()]
+        mask = np.array(y[area]) != "NaN"
+        gt = torch.tensor([to_idx[item] for item in np.array(y[area])[mask]])
+        return mask, gt.to(device)
 
     def forward(self, x, y):
         """
@@ -126,42 +156,31 @@ class HierarchicalCrossEntropy(nn.Module):
         Returns:
             torch.Tensor: Hierarchical CrossEntropy  loss between x and y: torch.Tensor([B])
         """
-        country_mask = np.array(y["unique_country"]) != "NaN"
-        self.city_to_country = self.city_to_country.to(x["label"].device)
+        device = x["label"].device
+        country_mask, country_gt = self.targets(
+            y, "unique_country", self.country_to_idx, device
+        )
+        self.city_to_country = self.city_to_country.to(device)
         countries_probas = nn.functional.softmax(x["label"][country_mask], dim=1)
         countries_logits = torch.log(
             torch.mm(countries_probas, self.city_to_country) + 1e-10
         )
-        country_gt = torch.tensor(
-            [
-                self.country_to_idx[item]
-                for item in np.array(y["unique_country"])[country_mask]
-            ]
-        ).to(x["label"].device)
 
-        region_mask = np.array(y["unique_region"]) != "NaN"
-        self.city_to_region = self.city_to_region.to(x["label"].device)
+        region_mask, region_gt = self.targets(
+            y, "unique_region", self.region_to_idx, device
+        )
+        self.city_to_region = self.city_to_region.to(device)
         regions_probas = nn.functional.softmax(x["label"][region_mask], dim=1)
         regions_logits = torch.log(
             torch.mm(regions_probas, self.city_to_region) + 1e-10
         )
-        region_gt = torch.tensor(
-            [
-                self.region_to_idx[item]
-                for item in np.array(y["unique_region"])[region_mask]
-            ]
-        ).to(x["label"].device)
 
-        area_mask = np.array(y["unique_sub-region"]) != "NaN"
-        self.city_to_area = self.city_to_area.to(x["label"].device)
+        area_mask, area_gt = self.targets(
+            y, "unique_sub-region", self.area_to_idx, device
+        )
+        self.city_to_area = self.city_to_area.to(device)
         areas_probas = nn.functional.softmax(x["label"][area_mask], dim=1)
         areas_logits = torch.log(torch.mm(areas_probas, self.city_to_area) + 1e-10)
-        area_gt = torch.tensor(
-            [
-                self.area_to_idx[item]
-                for item in np.array(y["unique_sub-region"])[area_mask]
-            ]
-        ).to(x["label"].device)
 
         return {
             "cross_entropy_country_loss": self.country_loss(
@@ -421,21 +440,32 @@ class MILNCE(nn.Module):
         """
         COmpute MIL-NCE loss
         """
+        # without pos_features, positives are the other samples of the batch with the
+        # same contrastive label (see data.samplers.ClassBalancedSampler)
+        in_batch = "pos_features" not in x
+        label_key = (
+            "label_contrastive" if in_batch and "label_contrastive" in y else "label"
+        )
         if self.distributed:
             all_image_features = torch.cat(
                 torch.distributed.nn.all_gather(x["features"]), dim=0
             )
-            all_pos_features = torch.cat(
-                torch.distributed.nn.all_gather(x["pos_features"]), dim=0
-            )
-            all_labels = torch.cat(torch.distributed.nn.all_gather(y["label"]), dim=0)
+            if not in_batch:
+                all_pos_features = torch.cat(
+                    torch.distributed.nn.all_gather(x["pos_features"]), dim=0
+                )
+            all_labels = torch.cat(torch.distributed.nn.all_gather(y[label_key]), dim=0)
         else:
             all_image_features = x["features"]
-            all_pos_features = x["pos_features"]
-            all_labels = y["label"]
+            if not in_batch:
+                all_pos_features = x["pos_features"]
+            all_labels = y[label_key]
         labels_u = torch.unique(all_labels)
-        features = torch.cat([all_image_features, all_pos_features])
-        labels = torch.cat([all_labels, all_labels])
+        if in_batch:
+            features, labels = all_image_features, all_labels
+        else:
+            features = torch.cat([all_image_features, all_pos_features])
+            labels = torch.cat([all_labels, all_labels])
         logits = self.cosine_similarity(features, features, normalize=True)
         rows, cols = logits.size()
         indices = torch.arange(0, rows, device=features.device)
@@ -452,6 +482,8 @@ class MILNCE(nn.Module):
                 pos_logits = logits[idx][:, idx]
 
                 rows, cols = pos_logits.size()
+                if rows < 2:  # no positive in the batch
+                    continue
                 indices = torch.arange(0, rows, device=features.device)
                 pos_logits = pos_logits[indices != indices.view(-1, 1)].view(
                     rows, cols - 1
@@ -484,21 +516,32 @@ class RegionMILNCE(nn.Module):
         neg_sim: BxB
         pos_sim: Bx1
         """
+        # without pos_features, positives are the other samples of the batch with the
+        # same contrastive label (see data.samplers.ClassBalancedSampler)
+        in_batch = "pos_features" not in x
+        label_key = (
+            "label_contrastive" if in_batch and "label_contrastive" in y else "label"
+        )
         if self.distributed:
             all_image_features = torch.cat(
                 torch.distributed.nn.all_gather(x["features"]), dim=0
             )
-            all_pos_features = torch.cat(
-                torch.distributed.nn.all_gather(x["pos_features"]), dim=0
-            )
-            all_labels = torch.cat(torch.distributed.nn.all_gather(y["label"]), dim=0)
+            if not in_batch:
+                all_pos_features = torch.cat(
+                    torch.distributed.nn.all_gather(x["pos_features"]), dim=0
+                )
+            all_labels = torch.cat(torch.distributed.nn.all_gather(y[label_key]), dim=0)
         else:
             all_image_features = x["features"]
-            all_pos_features = x["pos_features"]
-            all_labels = y["label"]
+            if not in_batch:
+                all_pos_features = x["pos_features"]
+            all_labels = y[label_key]
         labels_u = torch.unique(all_labels)
-        features = torch.cat([all_image_features, all_pos_features])
-        labels = torch.cat([all_labels, all_labels])
+        if in_batch:
+            features, labels = all_image_features, all_labels
+        else:
+            features = torch.cat([all_image_features, all_pos_features])
+            labels = torch.cat([all_labels, all_labels])
         logits = self.cosine_similarity(features, features, normalize=True)
         rows, cols = logits.size()
         indices = torch.arange(0, rows, device=features.device)
@@ -515,6 +558,8 @@ class RegionMILNCE(nn.Module):
                 pos_logits = logits[idx][:, idx]
 
                 rows, cols = pos_logits.size()
+                if rows < 2:  # no positive in the batch
+                    continue
                 indices = torch.arange(0, rows, device=features.device)
                 pos_logits = pos_logits[indices != indices.view(-1, 1)].view(
                     rows, cols - 1
@@ -594,6 +639,12 @@ class Losses(nn.Module):
                 except KeyError:
                     raise KeyError(f"Loss {m} not found in {LOSSES.keys()}")
 
+    def set_area_vocabularies(self, vocabularies):
+        """Passes the vocabularies of the unique_{area}_id of the batches to the losses."""
+        for loss, _ in self.loss.values():
+            if hasattr(loss, "set_area_vocabularies"):
+                loss.set_area_vocabularies(vocabularies)
+
     def forward(self, x, y, average=True):
         """Computes the losses.
         Args:
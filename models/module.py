@@ -21,6 +21,19 @@ class Geolocalizer(L.LightningModule):
         self.test_metrics = instantiate(cfg.test_metrics)
         self.text_tuning = cfg.text_tuning
 
+    def setup(self, stage=None):
+        # integer area ids of the batches are decoded with the vocabularies of the data
+        datamodule = getattr(self.trainer, "datamodule", None)
+        vocabularies = getattr(datamodule, "area_vocabularies", None)
+        if vocabularies is not None:
+            for module in [self.loss, self.val_metrics, self.test_metrics]:
+                if hasattr(module, "set_area_vocabularies"):
+                    module.set_area_vocabularies(vocabularies)
+        # the text model tokenizes the sentences once and reads them by sentence_id
+        sentences = getattr(datamodule, "text_sentences", None)
+        if self.text_tuning and sentences is not None:
+            self.text_model.set_sentences(sentences)
+
     def training_step(self, batch, batch_idx):
         pred = self.model(batch)
         if self.text_tuning:
@@ -36,6 +49,35 @@ class Geolocalizer(L.LightningModule):
             )
         return loss
 
+    def on_train_epoch_start(self):
+        # progressive resolution, the backbones interpolate their positional embeddings
+        datamodule = getattr(self.trainer, "datamodule", None)
+        if getattr(datamodule, "resolution_schedule", None) is not None:
+            resolution = datamodule.set_train_resolution(self.current_epoch)
+            self.log(
+                "train/resolution",
+                float(resolution),
+                sync_dist=True,
+                on_step=False,
+                on_epoch=True,
+            )
+
+    def on_train_epoch_end(self):
+        datamodule = getattr(self.trainer, "datamodule", None)
+        train_dataset = getattr(datamodule, "train_dataset", None)
+        for cache_name in ["image_cache", "local_cache"]:
+            cache = getattr(train_dataset, cache_name, None)
+            if cache is None:
+                continue
+            for stat_name, stat_value in cache.stats().items():
+                self.log(
+                    f"{cache_name}/{stat_name}",
+                    float(stat_value),
+                    sync_dist=True,
+                    on_step=False,
+                    on_epoch=True,
+                )
+
     @torch.no_grad()
     def validation_step(self, batch, batch_idx):
         pred = self.model(batch)
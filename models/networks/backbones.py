@@ -1,3 +1,4 @@
+import torch
 import torch.hub
 
 from transformers import (
@@ -18,6 +19,13 @@ from PIL import Image
 import requests
 
 
+def interpolate_pos_encoding(clip, img):
+    """Whether the positional embeddings of a CLIP vision model must be interpolated
+    for the resolution of the images, e.g. with a progressive resolution schedule.
+    """
+    return tuple(img.shape[-2:]) != (clip.config.image_size, clip.config.image_size)
+
+
 class CLIP(nn.Module):
     def __init__(self, path):
         """Initializes the CLIP model."""
@@ -33,7 +41,10 @@ class CLIP(nn.Module):
         Args:
             x (dict that contains "img": torch.Tensor): Input batch
         """
-        features = self.clip(pixel_values=x["img"])["last_hidden_state"]
+        features = self.clip(
+            pixel_values=x["img"],
+            interpolate_pos_encoding=interpolate_pos_encoding(self.clip, x["img"]),
+        )["last_hidden_state"]
         return features
 
 
@@ -52,7 +63,10 @@ class CLIPJZ(nn.Module):
         Args:
             x (dict that contains "img": torch.Tensor): Input batch
         """
-        features = self.clip(pixel_values=x["img"])["last_hidden_state"]
+        features = self.clip(
+            pixel_values=x["img"],
+            interpolate_pos_encoding=interpolate_pos_encoding(self.clip, x["img"]),
+        )["last_hidden_state"]
         return features
 
 
@@ -89,13 +103,21 @@ class CLIPText(nn.Module):
         Args:
             x (dict that contains "img": torch.Tensor): Input batch
         """
-        features = self.clip(pixel_values=x["img"])
+        features = self.clip(
+            pixel_values=x["img"],
+            interpolate_pos_encoding=interpolate_pos_encoding(self.clip, x["img"]),
+        )
         return features.image_embeds, features.last_hidden_state
 
 
 class TextEncoder(nn.Module):
-    def __init__(self, path):
-        """Initializes the CLIP text model."""
+    def __init__(self, path, cache_embeddings=True):
+        """Initializes the CLIP text model.
+        Args:
+            path (str): path of the pretrained CLIP model
+            cache_embeddings (bool): keep the embedding of every sentence id once
+                computed, the text model being frozen
+        """
         super().__init__()
         if path == "":
             config_vision = CLIPTextConfig()
@@ -107,12 +129,57 @@ class TextEncoder(nn.Module):
         for p in self.clip.parameters():
             p.requires_grad = False
         self.clip.eval()
+        self.cache_embeddings = cache_embeddings
+        # plain tensors rather than buffers: DDP would broadcast buffers from rank 0
+        # at every forward, overwriting the embeddings cached by each rank
+        self.input_ids = None
+
+    def set_sentences(self, sentences):
+        """Tokenizes the sentences of the dataset once, indexed by "sentence_id".
+        Args:
+            sentences (list): sentence of every sentence id
+        """
+        tokens = self.transform(sentences, padding=True, return_tensors="pt")
+        self.input_ids = tokens["input_ids"]
+        self.attention_mask = tokens["attention_mask"]
+        self.embeddings = torch.zeros(len(sentences), self.clip.config.projection_dim)
+        self.cached = torch.zeros(len(sentences), dtype=torch.bool)
+
+    def sentences_to(self, device):
+        """Moves the tokens and the embedding cache, not moved by Module.to, to the
+        device of the text model.
+        """
+        for name in ["input_ids", "attention_mask", "embeddings", "cached"]:
+            setattr(self, name, getattr(self, name).to(device))
+
+    def encode(self, sentence_ids):
+        """Embeds sentences from their token ids, padded to the longest one."""
+        attention_mask = self.attention_mask[sentence_ids]
+        length = int(attention_mask.sum(dim=1).max())
+        return self.clip(
+            input_ids=self.input_ids[sentence_ids, :length],
+            attention_mask=attention_mask[:, :length],
+        ).text_embeds
 
     def forward(self, x):
         """Predicts CLIP features from text.
         Args:
-            x (dict that contains "text": list): Input batch
+            x (dict that contains "text": list or "sentence_id": torch.Tensor): Input batch
         """
+        if self.input_ids is not None and "sentence_id" in x:
+            device = self.clip.text_projection.weight.device
+            if self.input_ids.device != device:
+                self.sentences_to(device)
+            sentence_ids = x["sentence_id"].to(device)
+            if not self.cache_embeddings:
+                return self.encode(sentence_ids)
+            missing = torch.unique(sentence_ids[~self.cached[sentence_ids]])
+            if len(missing) > 0:
+                with torch.no_grad():
+                    embeddings = self.encode(missing)
+                self.embeddings[missing] = embeddings.to(self.embeddings.dtype)
+                self.cached[missing] = True
+            return self.embeddings[sentence_ids]
         features = self.clip(
             **self.transform(x["text"], padding=True, return_tensors="pt").to(
                 x["gps"].device
@@ -129,14 +129,16 @@ class NoFeatureBackbone(nn.Module):
 class ContrastiveFrozenBackbone(FrozenBackbone):
     """Freezes the backbone of a network."""
 
-    def __init__(self, backbone, mid, head, mode):
+    def __init__(self, backbone, mid, head, mode, in_batch_positives=False):
         super().__init__(backbone, mid, head)
         self.mode = mode
+        # positives come from the other samples of the batch, no pos_img to encode
+        self.in_batch_positives = in_batch_positives
 
     def forward(self, x):
         with torch.no_grad():
             features = self.backbone(x)
-            if self.mode != "eval":
+            if self.mode != "eval" and not self.in_batch_positives:
                 x_pos = {
                     k.strip("pos_"): v.clone()
                     if isinstance(v, torch.Tensor)
@@ -147,7 +149,7 @@ class ContrastiveFrozenBackbone(FrozenBackbone):
                 pos_features = self.backbone(x_pos)
         x = self.mid(features)
         x = self.head(x)
-        if self.mode != "eval":
+        if self.mode != "eval" and not self.in_batch_positives:
             return {
                 "features": features[:, 0, :],
                 "pos_features": pos_features[:, 0, :],
@@ -162,13 +164,15 @@ class ContrastiveFrozenBackbone(FrozenBackbone):
 class ContrastiveUnFrozenPartBackbone(UnfrozenPartBackbone):
     """Freezes the backbone of a network."""
 
-    def __init__(self, backbone, mid, head, mode):
+    def __init__(self, backbone, mid, head, mode, in_batch_positives=False):
         super().__init__(backbone, mid, head)
         self.mode = mode
+        # positives come from the other samples of the batch, no pos_img to encode
+        self.in_batch_positives = in_batch_positives
 
     def forward(self, x):
         features = self.backbone(x)
-        if self.mode != "eval":
+        if self.mode != "eval" and not self.in_batch_positives:
             x_pos = {
                 k.strip("pos_"): v.clone()
                 if isinstance(v, torch.Tensor)
@@ -179,7 +183,7 @@ class ContrastiveUnFrozenPartBackbone(UnfrozenPartBackbone):
             pos_features = self.backbone(x_pos)
         x = self.mid(features)
         x = self.head(x)
-        if self.mode != "eval":
+        if self.mode != "eval" and not self.in_batch_positives:
             return {
                 "features": features[:, 0, :],
                 "pos_features": pos_features[:, 0, :],
@@ -194,13 +198,15 @@ class ContrastiveUnFrozenPartBackbone(UnfrozenPartBackbone):
 class ContrastiveUnFrozenBackbone(UnfrozenBackbone):
     """Freezes the backbone of a network."""
 
-    def __init__(self, backbone, mid, head, mode):
+    def __init__(self, backbone, mid, head, mode, in_batch_positives=False):
         super().__init__(backbone, mid, head)
         self.mode = mode
+        # positives come from the other samples of the batch, no pos_img to encode
+        self.in_batch_positives = in_batch_positives
 
     def forward(self, x):
         features = self.backbone(x)
-        if self.mode != "eval":
+        if self.mode != "eval" and not self.in_batch_positives:
             x_pos = {
                 k.strip("pos_"): v.clone()
                 if isinstance(v, torch.Tensor)
@@ -211,7 +217,7 @@ class ContrastiveUnFrozenBackbone(UnfrozenBackbone):
             pos_features = self.backbone(x_pos)
         x = self.mid(features)
         x = self.head(x)
-        if self.mode != "eval":
+        if self.mode != "eval" and not self.in_batch_positives:
             return {
                 "features": features[:, 0, :],
                 "pos_features": pos_features[:, 0, :],
@@ -305,14 +311,16 @@ class HybridUnfrozenBackbone(UnfrozenBackbone):
 class ContrastiveHybridUnFrozenBackbone(UnfrozenBackbone):
     """Freezes the backbone of a network."""
 
-    def __init__(self, backbone, mid, head, mode):
+    def __init__(self, backbone, mid, head, mode, in_batch_positives=False):
         super().__init__(backbone, mid, head)
         self.mode = mode
+        # positives come from the other samples of the batch, no pos_img to encode
+        self.in_batch_positives = in_batch_positives
 
     def forward(self, x):
         gt_label = x["label"] if self.training else None
         features = self.backbone(x)
-        if self.mode != "eval":
+        if self.mode != "eval" and not self.in_batch_positives:
             x_pos = {
                 k.strip("pos_"): v.clone()
                 if isinstance(v, torch.Tensor)
@@ -323,7 +331,7 @@ class ContrastiveHybridUnFrozenBackbone(UnfrozenBackbone):
             pos_features = self.backbone(x_pos)
         x = self.mid(features)
         x = self.head(x, gt_label)
-        if self.mode != "eval":
+        if self.mode != "eval" and not self.in_batch_positives:
             return {
                 "features": features[:, 0, :],
                 "pos_features": pos_features[:, 0, :],
@@ -0,0 +1,73 @@
+"""
+Compares the "pil" and "tensor" backends of the augmentation train transform:
+throughput, and statistics of the augmented images, which should agree.
+
+python scripts/benchmarks/augmentation.py --image_dir datasets/osv5m/images/train
+"""
+
+import sys
+import time
+from glob import glob
+from os.path import dirname, abspath, join
+
+import torch
+from PIL import Image
+from hydra.utils import instantiate
+from omegaconf import OmegaConf
+
+sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+CONFIG = join(
+    dirname(dirname(dirname(abspath(__file__)))),
+    "configs/dataset/train_transform/augmentation.yaml",
+)
+
+
+def augment(images, backend, batch_size, device):
+    config = OmegaConf.load(CONFIG)
+    config.backend = backend
+    transform = instantiate(config)
+    outputs = []
+    start = time.perf_counter()
+    for k in range(0, len(images), batch_size):
+        batch = torch.stack([transform(img) for img in images[k : k + batch_size]])
+        batch = batch.to(device)
+        if transform.batch_augmentation is not None:
+            batch = transform.batch_augmentation(batch)
+        outputs.append(batch.cpu())
+    return torch.cat(outputs), len(images) / (time.perf_counter() - start)
+
+
+def statistics(imgs):
+    """Per-image mean, std and horizontal gradient, averaged over the images."""
+    return {
+        "mean": imgs.mean(dim=(1, 2, 3)).mean().item(),
+        "std": imgs.std(dim=(2, 3)).mean().item(),
+        "gradient": (imgs[..., 1:] - imgs[..., :-1]).abs().mean().item(),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image_dir", default="datasets/osv5m/images/train")
+    parser.add_argument("--num_images", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=4)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    paths = sorted(glob(join(args.image_dir, "**", "*.jpg"), recursive=True))
+    images = [Image.open(path).convert("RGB") for path in paths[: args.num_images]]
+    for img in images:
+        img.load()
+    images = images * args.repeats
+
+    results = {}
+    for backend in ["pil", "tensor"]:
+        imgs, speed = augment(images, backend, args.batch_size, args.device)
+        results[backend] = speed
+        stats = ", ".join(f"{k} {v:.4f}" for k, v in statistics(imgs).items())
+        print(f"{backend:>6}: {speed:.1f} images/s, {stats}")
+    print(f"tensor backend: {results['tensor'] / results['pil']:.2f}x")
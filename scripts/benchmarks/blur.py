@@ -0,0 +1,74 @@
+"""
+Compares data.augmentation.BottomBlur with the blur of osv5m(blur=True) it replaced,
+which converted the whole image to a float tensor and back to blur its bottom rows.
+
+python scripts/benchmarks/blur.py --image_dir datasets/osv5m/images/test
+"""
+
+import sys
+import time
+from glob import glob
+from os.path import dirname, abspath, join
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+from data.augmentation import BottomBlur
+
+
+def legacy_blur(img):
+    img = transforms.ToTensor()(img)
+    u = transforms.GaussianBlur(kernel_size=13, sigma=2.0)
+    bottom_part = img[:, -14:, :].unsqueeze(0)
+    blurred_bottom = u(bottom_part)
+    img[:, -14:, :] = blurred_bottom.squeeze()
+    return transforms.ToPILImage()(img)
+
+
+def blur_images(paths, blur, transform):
+    outputs = []
+    start = time.perf_counter()
+    for path in paths:
+        outputs.append(transform(blur(Image.open(path))))
+    return outputs, len(paths) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image_dir", default="datasets/osv5m/images/test")
+    parser.add_argument("--num_images", type=int, default=500)
+    parser.add_argument("--size", type=int, default=224)
+    args = parser.parse_args()
+
+    paths = sorted(glob(join(args.image_dir, "**", "*.jpg"), recursive=True))
+    paths = paths[: args.num_images]
+    # fast_clip before ToTensor/Normalize, so that outputs are compared exactly
+    transform = transforms.Compose(
+        [
+            transforms.Resize(args.size, interpolation=3, antialias=True),
+            transforms.CenterCrop(args.size),
+            transforms.PILToTensor(),
+        ]
+    )
+    blur_images(paths[:10], legacy_blur, transform)  # warm up the file cache
+
+    legacy, legacy_speed = blur_images(paths, legacy_blur, transform)
+    fused, fused_speed = blur_images(paths, BottomBlur(), transform)
+    mismatches = [
+        path for path, a, b in zip(paths, legacy, fused) if not torch.equal(a, b)
+    ]
+
+    print(f"{len(paths)} images, output size {args.size}")
+    print(f"legacy blur: {legacy_speed:.1f} images/s")
+    print(f"fused blur:  {fused_speed:.1f} images/s ({fused_speed / legacy_speed:.2f}x)")
+    if mismatches:
+        diff = np.mean([(a.float() - b.float()).abs().max() for a, b in zip(legacy, fused)])
+        print(f"{len(mismatches)} images differ, mean max difference {diff:.2f}")
+        sys.exit(1)
+    print("outputs are identical")
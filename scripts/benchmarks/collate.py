@@ -0,0 +1,110 @@
+"""
+Compares data.collate.Collator with the per-key torch.stack collate it replaced,
+on synthetic osv5m samples, in the main process and in DataLoader workers.
+
+python scripts/benchmarks/collate.py --batch_size 256
+"""
+
+import sys
+import time
+from os.path import dirname, abspath
+
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+from data.collate import Collator, LIST_KEYS
+
+
+def legacy_collate_fn(batch):
+    keys = list(batch[0].keys())
+    if "weight" in batch[0].keys():
+        keys.remove("weight")
+    output = {}
+    for key in LIST_KEYS:
+        if key in keys:
+            output[key] = [x[key] for x in batch]
+            keys.remove(key)
+    for key in keys:
+        if not ("text" in key):
+            output[key] = torch.stack([x[key] for x in batch])
+    return output
+
+
+class Samples(Dataset):
+    def __init__(self, size, resolution):
+        self.size = size
+        self.img = torch.rand(3, resolution, resolution)
+
+    def __getitem__(self, i):
+        sample = {
+            "img": self.img.clone(),
+            "gps": torch.rand(2),
+            "idx": i,
+            "img_idx": 1000000 + i,
+            "weight": 1.0,
+            "label": torch.tensor(i % 1000),
+        }
+        for area in ["country", "region", "sub-region", "city"]:
+            sample[f"unique_{area}"] = f"{area}_{i % 97}"
+            sample[f"unique_{area}_id"] = torch.tensor(i % 97, dtype=torch.int32)
+        sample["land_cover"] = torch.rand(11)
+        sample["climate"] = torch.rand(30)
+        return sample
+
+    def __len__(self):
+        return self.size
+
+
+def time_collate(collate, batch, repeats):
+    collate(batch)  # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        collate(batch)
+    return (time.perf_counter() - start) / repeats
+
+
+def time_loader(dataset, collate, batch_size, num_workers):
+    loader = DataLoader(
+        dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=collate
+    )
+    start = time.perf_counter()
+    for _ in loader:
+        pass
+    return len(dataset) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--resolution", type=int, default=224)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--num_workers", type=int, default=2)
+    parser.add_argument("--num_batches", type=int, default=20)
+    args = parser.parse_args()
+
+    dataset = Samples(args.batch_size * args.num_batches, args.resolution)
+    batch = [dataset[i] for i in range(args.batch_size)]
+    collator = Collator()
+
+    expected, output = legacy_collate_fn(batch), collator(batch)
+    assert list(expected.keys()) == list(output.keys())
+    for key in expected:
+        if isinstance(expected[key], torch.Tensor):
+            assert torch.equal(expected[key], output[key]), key
+        else:
+            assert expected[key] == output[key], key
+
+    print(f"batch of {args.batch_size} samples at {args.resolution}px")
+    legacy = time_collate(legacy_collate_fn, batch, args.repeats)
+    new = time_collate(collator, batch, args.repeats)
+    print(f"main process: legacy {1000 * legacy:.2f} ms, collator {1000 * new:.2f} ms")
+    legacy = time_loader(dataset, legacy_collate_fn, args.batch_size, args.num_workers)
+    new = time_loader(dataset, collator, args.batch_size, args.num_workers)
+    print(
+        f"{args.num_workers} workers: legacy {legacy:.0f} samples/s, "
+        f"collator {new:.0f} samples/s"
+    )
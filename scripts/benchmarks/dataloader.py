@@ -0,0 +1,277 @@
+"""
+Measures how many images per second osv5m and ImageDataModule deliver on this machine,
+with the time of every stage of a sample (index lookup, read, decode, transform) and
+of collate, then the end-to-end throughput of the train DataLoader.
+
+With --autotune, num_workers, prefetch_factor, persistent_workers and pin_memory are
+swept one after the other, each keeping the best value of the previous ones, and the
+best settings are written as a computer config extending --computer, to be used with
+computer=<computer>-tuned.
+
+A synthetic image tree can be generated to benchmark without the dataset:
+python scripts/benchmarks/dataloader.py --data_dir /tmp/synthetic --synthetic 2000
+python scripts/benchmarks/dataloader.py --data_dir datasets --transform augmentation --autotune
+"""
+
+import io
+import os
+import sys
+import time
+from os.path import dirname, abspath, join, isfile
+
+import numpy as np
+import pandas as pd
+import torch
+from hydra.utils import instantiate
+from omegaconf import OmegaConf
+from PIL import Image
+
+ROOT = dirname(dirname(dirname(abspath(__file__))))
+sys.path.append(ROOT)
+
+from data.data import osv5m
+from data.datamodule import ImageDataModule
+
+
+def make_synthetic_dataset(data_dir, num_images, size, seed=0):
+    """Writes train.csv, test.csv and smooth random jpgs in the osv5m layout."""
+    rng = np.random.default_rng(seed)
+    path = join(data_dir, "osv5m")
+    for split, num, first_id in [("train", num_images, 0), ("test", num_images // 10, 10**7)]:
+        if isfile(join(path, f"{split}.csv")):
+            continue
+        ids = np.arange(first_id, first_id + num)
+        countries = rng.choice(["FR", "US", "JP", "BR", "ZA"], num)
+        df = pd.DataFrame(
+            {
+                "id": ids,
+                "latitude": rng.uniform(-60, 70, num),
+                "longitude": rng.uniform(-180, 180, num),
+                "country": countries,
+                "region": [f"{c}-{r}" for c, r in zip(countries, rng.integers(5, size=num))],
+                "sub-region": rng.integers(20, size=num).astype(str),
+                "city": rng.integers(100, size=num).astype(str),
+            }
+        )
+        for area in ["country", "region", "sub-region", "city"]:
+            df[f"unique_{area}"] = df[area]
+        for coord, name in [("longitude", "lon_bin"), ("latitude", "lat_bin")]:
+            bins = np.linspace(df[coord].min(), df[coord].max(), 100)
+            df[name] = np.clip(np.digitize(df[coord], bins) - 1, 0, 98)
+        width, height = size
+        for k, img_id in enumerate(ids):
+            folder = join(path, "images", split, f"{k % 10:02d}")
+            os.makedirs(folder, exist_ok=True)
+            # low frequency noise compresses like a photo rather than like white noise
+            small = rng.integers(0, 256, (height // 16, width // 16, 3), dtype=np.uint8)
+            img = Image.fromarray(small).resize((width, height), Image.BICUBIC)
+            img.save(join(folder, f"{img_id}.jpg"), quality=90)
+        df.to_csv(join(path, f"{split}.csv"), index=False)
+
+
+def load_transform(name, img_resolution):
+    """Instantiates configs/dataset/train_transform/<name>.yaml."""
+    config = OmegaConf.create(
+        {
+            "dataset": {"img_resolution": img_resolution},
+            "transform": OmegaConf.load(
+                join(ROOT, "configs", "dataset", "train_transform", f"{name}.yaml")
+            ),
+        }
+    )
+    return instantiate(config.transform)
+
+
+def time_stages(dataset, num_samples, batch_size, seed=0):
+    """Returns the mean time per image of every stage, in seconds."""
+    indices = np.random.default_rng(seed).choice(len(dataset), num_samples)
+    times = {"index": 0.0, "read": 0.0, "decode": 0.0, "transform": 0.0}
+    for i in indices:
+        start = time.perf_counter()
+        img_id = int(dataset.ids[i])
+        if dataset.storage == "shards":
+            dataset.shards.locate(img_id)
+        elif dataset.storage == "archives":
+            dataset.archives.locate(f"{img_id}.jpg")
+        else:
+            dataset.image_index.path(img_id)
+        times["index"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        data = dataset.read_image(img_id)
+        times["read"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        img = Image.open(io.BytesIO(data))
+        if dataset.draft_size is not None and not dataset.blur:
+            img.draft(img.mode, (dataset.draft_size, dataset.draft_size))
+        img.load()
+        times["decode"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        if dataset.blur:
+            img = dataset.bottom_blur(img)
+        dataset.transforms(img)
+        times["transform"] += time.perf_counter() - start
+    times = {stage: total / num_samples for stage, total in times.items()}
+
+    items = [dataset[int(i)] for i in indices[:batch_size]]
+    dataset.collate_fn(items)  # warm up
+    start = time.perf_counter()
+    for _ in range(5):
+        dataset.collate_fn(items)
+    times["collate"] = (time.perf_counter() - start) / (5 * len(items))
+    return times
+
+
+def throughput(dataset, options, batch_size, num_batches, epochs, device):
+    """Images per second of the train DataLoader of ImageDataModule, over a few short
+    epochs so that the worker start-up is counted as in training.
+    """
+    datamodule = ImageDataModule(
+        lambda: dataset,
+        lambda: dataset,
+        lambda: dataset,
+        global_batch_size=batch_size,
+        **options,
+    )
+    datamodule.setup("fit")
+    loader = datamodule.train_dataloader()
+    num_images = 0
+    start = time.perf_counter()
+    for _ in range(epochs):
+        for k, batch in enumerate(loader):
+            img = batch["img"]
+            if device != "cpu":
+                img = img.to(device, non_blocking=options["pin_memory"])
+            num_images += len(img)
+            if k + 1 == num_batches:
+                break
+    if device != "cpu":
+        torch.cuda.synchronize()
+    return num_images / (time.perf_counter() - start)
+
+
+def autotune(dataset, args, device):
+    """Sweeps the DataLoader options one at a time, returns the best and its speed."""
+    cpus = os.cpu_count()
+    sweeps = {
+        "num_workers": sorted({0, 1, 2, 4, 8, 16, cpus} & set(range(cpus + 1))),
+        "prefetch_factor": [2, 4, 8],
+        "persistent_workers": [False, True],
+        "pin_memory": [False, True] if device != "cpu" else [False],
+    }
+    best = {
+        "num_workers": 0,
+        "prefetch_factor": 2,
+        "persistent_workers": False,
+        "pin_memory": False,
+    }
+    best_speed = 0.0
+    for name, values in sweeps.items():
+        if name in ["prefetch_factor", "persistent_workers"] and best["num_workers"] == 0:
+            continue
+        for value in values:
+            options = {**best, name: value}
+            speed = throughput(
+                dataset,
+                {**options, "prefetch_depth": args.prefetch_depth},
+                args.batch_size,
+                args.num_batches,
+                args.epochs,
+                device,
+            )
+            print(f"  {name}={value}: {speed:.1f} images/s")
+            if speed > best_speed:
+                best, best_speed = options, speed
+    return best, best_speed
+
+
+def write_computer_config(path, computer, options, speed, args):
+    lines = [
+        f"# written by scripts/benchmarks/dataloader.py --autotune, {speed:.0f} images/s",
+        f"# with the {args.transform} transform, batch size {args.batch_size}, "
+        f"{args.storage} storage",
+        "defaults:",
+        f"  - {computer}",
+        "  - _self_",
+        "",
+    ]
+    lines += [f"{name}: {value}" for name, value in options.items()]
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default="datasets")
+    parser.add_argument("--split", default="train")
+    parser.add_argument("--transform", default="fast_clip")
+    parser.add_argument("--img_resolution", type=int, default=224)
+    parser.add_argument("--storage", default="folder")
+    parser.add_argument("--draft_size", type=int, default=None)
+    parser.add_argument("--blur", action="store_true")
+    parser.add_argument("--shm_cache_gb", type=float, default=0)
+    parser.add_argument("--prefetch_depth", type=int, default=0)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--prefetch_factor", type=int, default=2)
+    parser.add_argument("--persistent_workers", action="store_true")
+    parser.add_argument("--pin_memory", action="store_true")
+    parser.add_argument("--num_batches", type=int, default=20)
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--stage_samples", type=int, default=200)
+    parser.add_argument(
+        "--synthetic", type=int, default=0, help="generate this many train images"
+    )
+    parser.add_argument("--synthetic_size", type=int, nargs=2, default=[512, 384])
+    parser.add_argument("--autotune", action="store_true")
+    parser.add_argument("--computer", default="v100", help="config extended by --autotune")
+    parser.add_argument("--output", default=None, help="defaults to <computer>-tuned.yaml")
+    args = parser.parse_args()
+
+    if args.synthetic > 0:
+        make_synthetic_dataset(args.data_dir, args.synthetic, args.synthetic_size)
+    dataset = osv5m(
+        join(args.data_dir, "osv5m"),
+        load_transform(args.transform, args.img_resolution),
+        split=args.split,
+        storage=args.storage,
+        draft_size=args.draft_size,
+        blur=args.blur,
+        shm_cache_gb=args.shm_cache_gb,
+    )
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(
+        f"{len(dataset)} {args.split} images, {args.transform} transform, "
+        f"batch size {args.batch_size}, {os.cpu_count()} cpus, {device}"
+    )
+
+    times = time_stages(dataset, args.stage_samples, args.batch_size)
+    total = sum(times.values())
+    print("time per image in the main process:")
+    for stage, seconds in times.items():
+        print(f"  {stage:>9}: {1000 * seconds:7.3f} ms ({100 * seconds / total:4.1f}%)")
+    print(f"  {'total':>9}: {1000 * total:7.3f} ms, {1 / total:.1f} images/s per worker")
+
+    if args.autotune:
+        best, speed = autotune(dataset, args, device)
+        output = args.output or join(
+            ROOT, "configs", "computer", f"{args.computer}-tuned.yaml"
+        )
+        write_computer_config(output, args.computer, best, speed, args)
+        print(f"best: {best}, {speed:.1f} images/s, written to {output}")
+    else:
+        options = {
+            "num_workers": args.num_workers,
+            "prefetch_factor": args.prefetch_factor,
+            "persistent_workers": args.persistent_workers,
+            "pin_memory": args.pin_memory,
+            "prefetch_depth": args.prefetch_depth,
+        }
+        speed = throughput(
+            dataset, options, args.batch_size, args.num_batches, args.epochs, device
+        )
+        print(f"end to end: {speed:.1f} images/s with {options}")
@@ -0,0 +1,63 @@
+"""
+Compares full-resolution jpg decoding with the reduced-resolution (draft) decoding
+of osv5m(draft_size=...) on the fast_clip resize and center crop.
+
+python scripts/benchmarks/decode.py --image_dir datasets/osv5m/images/test
+"""
+
+import time
+from glob import glob
+from os.path import join
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+
+def decode(paths, transform, draft_size=None):
+    outputs = []
+    start = time.perf_counter()
+    for path in paths:
+        img = Image.open(path)
+        if draft_size is not None:
+            img.draft(img.mode, (draft_size, draft_size))
+        outputs.append(transform(img))
+    return outputs, len(paths) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image_dir", default="datasets/osv5m/images/test")
+    parser.add_argument("--num_images", type=int, default=500)
+    parser.add_argument("--size", type=int, default=224)
+    args = parser.parse_args()
+
+    paths = sorted(glob(join(args.image_dir, "**", "*.jpg"), recursive=True))
+    paths = paths[: args.num_images]
+    # fast_clip before ToTensor/Normalize, so that differences are in pixel values
+    transform = transforms.Compose(
+        [
+            transforms.Resize(args.size, interpolation=3, antialias=True),
+            transforms.CenterCrop(args.size),
+            transforms.PILToTensor(),
+        ]
+    )
+    decode(paths[:10], transform)  # warm up the file cache
+
+    full, full_speed = decode(paths, transform)
+    draft, draft_speed = decode(paths, transform, draft_size=args.size)
+    diff = torch.stack([(a.float() - b.float()).abs() for a, b in zip(full, draft)])
+    mse = (diff**2).mean(dim=(1, 2, 3))
+    psnr = 10 * torch.log10(255**2 / mse.clamp(min=1e-10))
+
+    print(f"{len(paths)} images, output size {args.size}")
+    print(f"full decode:  {full_speed:.1f} images/s")
+    print(f"draft decode: {draft_speed:.1f} images/s ({draft_speed / full_speed:.2f}x)")
+    print(
+        f"pixel difference: mean {diff.mean():.2f}, "
+        f"99th percentile {np.percentile(diff.numpy(), 99):.1f}, max {diff.max():.0f}"
+    )
+    print(f"PSNR: mean {psnr.mean():.2f} dB, min {psnr.min():.2f} dB")
@@ -1,27 +1,185 @@
-import os, zipfile
-from huggingface_hub import snapshot_download
+"""
+Downloads osv5m from the hub and unpacks its zip archives with a pool of processes.
 
-# Define the base directory
-base_dir = os.path.join(os.getcwd(), 'datasets')
+Every archive is checked against the sha256 published on the hub (and the crc32 of
+its members as they are read), and a manifest is written in <data_dir>/extraction
+once it is fully unpacked, so an interrupted run resumes with the remaining ones.
+The images of images/<split>/*.zip can be written as loose jpgs (--output folder),
+straight into the packed shards/<split> layout of data.shards (--output shards), or
+left in their archives to be read with storage=archives (--output archives).
 
-# Ensure the base directory exists
-if not os.path.exists(base_dir):
-    os.mkdir(base_dir)
+python scripts/download-dataset.py --num_workers 16
+python scripts/download-dataset.py --data_dir /tmp/osv5m --skip_download --output shards
+"""
 
-# Define the specific dataset directory
-dataset_dir = os.path.join(base_dir, "osv5m")
+import os
+import sys
+import json
+import hashlib
+import zipfile
+from os.path import dirname, abspath, join, relpath, basename, splitext, isfile
+from multiprocessing import Pool
 
-# Ensure the specific dataset directory exists
-if not os.path.exists(dataset_dir):
-    os.mkdir(dataset_dir)
+from tqdm import tqdm
 
-# Download the dataset
-snapshot_download(repo_id="osv5m/osv5m", local_dir=dataset_dir, repo_type='dataset')
+sys.path.append(dirname(dirname(abspath(__file__))))
 
-# Extract zip files and remove them after extraction
-for root, dirs, files in os.walk(dataset_dir):
-    for file in files:
-        if file.endswith(".zip"):
-            with zipfile.ZipFile(os.path.join(root, file), 'r') as zip_ref:
-                zip_ref.extractall(root)
-                os.remove(os.path.join(root, file))
+from data.shards import ShardWriter, merge_shard_indexes
+from data.utils import save_json_atomic
+
+
+def download(data_dir, repo_id):
+    """Downloads the dataset and writes the sha256 of its lfs files to checksums.json."""
+    from huggingface_hub import HfApi, snapshot_download
+
+    snapshot_download(repo_id=repo_id, local_dir=data_dir, repo_type="dataset")
+    checksums = {
+        file.path: file.lfs.sha256
+        for file in HfApi().list_repo_tree(repo_id, recursive=True, repo_type="dataset")
+        if getattr(file, "lfs", None) is not None
+    }
+    save_json_atomic(join(data_dir, "checksums.json"), checksums)
+
+
+def sha256sum(path, chunk_size=1 << 24):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def image_split(data_dir, archive):
+    """Returns the split of an archive of images/<split>, None for other archives."""
+    parts = relpath(archive, data_dir).split(os.sep)
+    return parts[1] if len(parts) == 3 and parts[0] == "images" else None
+
+
+def manifest_path(data_dir, archive):
+    return join(data_dir, "extraction", relpath(archive, data_dir) + ".json")
+
+
+def extract_archive(job):
+    """Verifies an archive, unpacks it and writes its manifest.
+    Returns:
+        tuple: (archive, number of members written)
+    """
+    data_dir, archive, expected_sha256, output = job
+    sha256 = sha256sum(archive)
+    if expected_sha256 is not None and sha256 != expected_sha256:
+        raise ValueError(
+            f"{archive} is corrupted: sha256 {sha256} instead of {expected_sha256}, "
+            "delete it and download it again"
+        )
+    split = image_split(data_dir, archive)
+    root = dirname(archive)
+    num_members = 0
+    with zipfile.ZipFile(archive) as zip_file:
+        if output == "shards" and split is not None:
+            # one shard per archive, rewritten from scratch if it was not sealed
+            shard = f"{split}-{splitext(basename(archive))[0]}"
+            with ShardWriter(join(data_dir, "shards", split), shard) as writer:
+                for info in zip_file.infolist():
+                    stem, ext = splitext(basename(info.filename))
+                    if info.is_dir() or ext.lower() != ".jpg" or not stem.isdigit():
+                        continue
+                    writer.write(int(stem), zip_file.read(info))  # checks the crc32
+                    num_members += 1
+        else:
+            for info in zip_file.infolist():
+                target = zip_file.extract(info, root)  # checks the crc32
+                if not info.is_dir():
+                    if os.path.getsize(target) != info.file_size:
+                        raise ValueError(f"{target} is truncated, extract {archive} again")
+                    num_members += 1
+    save_json_atomic(
+        manifest_path(data_dir, archive),
+        {
+            "sha256": sha256,
+            "size": os.path.getsize(archive),
+            "output": output if split is not None else "folder",
+            "num_members": num_members,
+        },
+    )
+    return archive, num_members
+
+
+def is_extracted(data_dir, archive, output):
+    """Whether the manifest of the archive says it was unpacked into output, from
+    this very archive.
+    """
+    path = manifest_path(data_dir, archive)
+    if not isfile(path):
+        return False
+    with open(path) as f:
+        manifest = json.load(f)
+    if image_split(data_dir, archive) is not None and manifest["output"] != output:
+        return False
+    return os.path.getsize(archive) == manifest["size"]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default=join(os.getcwd(), "datasets", "osv5m"))
+    parser.add_argument("--repo_id", default="osv5m/osv5m")
+    parser.add_argument("--skip_download", action="store_true")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--output",
+        default="folder",
+        choices=["folder", "shards", "archives"],
+        help="where the images of images/<split>/*.zip go, see data.data.osv5m storage",
+    )
+    parser.add_argument("--keep_archives", action="store_true")
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    if not args.skip_download:
+        download(args.data_dir, args.repo_id)
+    checksums = {}
+    if isfile(join(args.data_dir, "checksums.json")):
+        with open(join(args.data_dir, "checksums.json")) as f:
+            checksums = json.load(f)
+
+    archives = sorted(
+        join(root, file)
+        for root, _, files in os.walk(args.data_dir)
+        for file in files
+        if file.endswith(".zip")
+    )
+    if args.output == "archives":
+        # image archives are read in place, see data.archives
+        archives = [a for a in archives if image_split(args.data_dir, a) is None]
+    pending = [a for a in archives if not is_extracted(args.data_dir, a, args.output)]
+    print(f"{len(archives) - len(pending)} archives already extracted")
+    if not args.keep_archives:
+        for archive in set(archives) - set(pending):
+            os.remove(archive)
+    for archive in pending:
+        os.makedirs(dirname(manifest_path(args.data_dir, archive)), exist_ok=True)
+    jobs = [
+        (
+            args.data_dir,
+            archive,
+            checksums.get(relpath(archive, args.data_dir).replace(os.sep, "/")),
+            args.output,
+        )
+        for archive in pending
+    ]
+    # the biggest archives first, so that no worker is left with one at the end
+    jobs.sort(key=lambda job: -os.path.getsize(job[1]))
+    with Pool(max(1, min(args.num_workers, len(jobs)))) as pool:
+        for archive, num_members in tqdm(
+            pool.imap_unordered(extract_archive, jobs), total=len(jobs)
+        ):
+            if not args.keep_archives:
+                os.remove(archive)
+
+    if args.output == "shards" and os.path.isdir(join(args.data_dir, "shards")):
+        # also the splits whose archives were all removed by an interrupted run
+        for split in sorted(os.listdir(join(args.data_dir, "shards"))):
+            shard_folder = join(args.data_dir, "shards", split)
+            num_images = merge_shard_indexes(shard_folder)
+            print(f"Indexed {num_images} images in {shard_folder}")
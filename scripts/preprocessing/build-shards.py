@@ -0,0 +1,50 @@
+import sys
+from os.path import dirname, abspath, join
+from multiprocessing import Pool
+
+from tqdm import tqdm
+
+sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+from data.shards import ShardWriter, merge_shard_indexes
+from data.image_index import walk_images
+
+
+def write_shard(args):
+    shard_folder, name, images = args
+    with ShardWriter(shard_folder, name) as writer:
+        for image_id, image_path in images:
+            with open(image_path, "rb") as f:
+                writer.write(image_id, f.read())
+    return len(images)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Packs the images/<split> tree of osv5m into shards/<split>"
+    )
+    parser.add_argument("--data_dir", default="datasets/osv5m")
+    parser.add_argument("--splits", nargs="+", default=["train", "test"])
+    parser.add_argument("--images_per_shard", type=int, default=50000)
+    parser.add_argument("--num_workers", type=int, default=8)
+    args = parser.parse_args()
+
+    for split in args.splits:
+        image_folder = join(args.data_dir, "images", split)
+        images = [
+            (image_id, join(image_folder, path))
+            for image_id, path in walk_images(image_folder)
+        ]
+        shard_folder = join(args.data_dir, "shards", split)
+        jobs = [
+            (shard_folder, f"{split}-{k:05d}", images[start : start + args.images_per_shard])
+            for k, start in enumerate(range(0, len(images), args.images_per_shard))
+        ]
+        print(f"Packing {len(images)} {split} images into {len(jobs)} shards")
+        with Pool(args.num_workers) as pool:
+            for _ in tqdm(pool.imap_unordered(write_shard, jobs), total=len(jobs)):
+                pass
+        num_images = merge_shard_indexes(shard_folder)
+        print(f"Indexed {num_images} images in {shard_folder}")
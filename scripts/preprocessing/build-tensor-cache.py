@@ -0,0 +1,93 @@
+import sys
+from os.path import dirname, abspath, join
+
+from tqdm import tqdm
+from omegaconf import OmegaConf
+from omegaconf.errors import InterpolationResolutionError
+from hydra.utils import instantiate
+from torch.utils.data import Dataset, DataLoader
+
+sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+from data.data import osv5m
+from data.tensor_cache import TensorCache, split_transforms
+
+
+class PreTransformed(Dataset):
+    """Serves the uint8 output of the cacheable transforms of every image."""
+
+    def __init__(self, dataset, pre_transforms):
+        self.dataset = dataset
+        self.pre_transforms = pre_transforms
+
+    def __getitem__(self, i):
+        img_id = int(self.dataset.ids[i])
+        return i, self.dataset.load_image(img_id, self.pre_transforms)
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Caches the resized and cropped uint8 images of osv5m splits"
+    )
+    parser.add_argument("--data_dir", default="datasets/osv5m")
+    parser.add_argument("--splits", nargs="+", default=["val", "test"])
+    parser.add_argument(
+        "--transform",
+        default="fast_clip",
+        help="name of a config in configs/dataset/test_transform",
+    )
+    parser.add_argument("--storage", default="folder")
+    parser.add_argument("--draft_size", type=int, default=None)
+    parser.add_argument("--blur", action="store_true")
+    parser.add_argument("--suff", default="")
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--num_workers", type=int, default=8)
+    args = parser.parse_args()
+
+    root = dirname(dirname(dirname(abspath(__file__))))
+    config = join(root, "configs", "dataset", "test_transform", f"{args.transform}.yaml")
+    try:
+        transforms = instantiate(OmegaConf.load(config))
+    except InterpolationResolutionError as e:
+        raise ValueError(
+            f"{config} cannot be loaded on its own ({e}), only test transforms "
+            "resizing and cropping to a fixed size, such as fast_clip, can be cached"
+        ) from e
+    pre_transforms, _ = split_transforms(transforms, name=args.transform)
+
+    for split in args.splits:
+        dataset = osv5m(
+            args.data_dir,
+            transforms,
+            split=split,
+            suff=args.suff,
+            blur=args.blur,
+            storage=args.storage,
+            draft_size=args.draft_size,
+        )
+        cache_path = dataset.tensor_cache_path(pre_transforms)
+        loader = DataLoader(
+            PreTransformed(dataset, pre_transforms),
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+        )
+        print(f"Caching {len(dataset)} {split} images to {cache_path}.npy")
+        array = None
+        for rows, images in tqdm(loader):
+            if array is None:
+                array = TensorCache.create(cache_path, len(dataset), images.shape[1:])
+            array[rows.numpy()] = images.numpy()
+        array.flush()
+        TensorCache.seal(
+            cache_path,
+            dataset.ids,
+            split=split,
+            transforms=repr(pre_transforms),
+            draft_size=args.draft_size,
+            blur=args.blur,
+        )
@@ -6,6 +6,7 @@ from os.path import dirname, join
 
 sys.path.append(dirname(dirname(__file__)))
 
+import numpy as np
 import torch
 from transformers import AutoImageProcessor, AutoModel
 from transformers import CLIPProcessor, CLIPModel
@@ -49,7 +50,8 @@ def compute_clip(processor, model, x):
 def get_batch(dataset, batch_size):
     data, lats, lons, ids = [], [], [], []
     for i in range(len(dataset)):
-        id, lat, lon = dataset.df.iloc[i]
+        id = dataset.ids[i]
+        lat, lon = np.degrees(dataset.gps[i]).tolist()
         data.append(Image.open(join(dataset.image_folder, f"{int(id)}.jpg")))
         lats.append(lat)
         lons.append(lon)
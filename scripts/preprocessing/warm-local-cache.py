@@ -0,0 +1,64 @@
+"""
+Fills the local disk cache of osv5m (local_cache_dir, local_cache_gb) before a run,
+from a manifest listing the files to copy, one path relative to the dataset per line.
+
+Without an existing --manifest, the files read by the given splits with the given
+storage are listed, in the order of the splits and of their samples, and written
+to --manifest if set, to warm up the other nodes with the same files.
+
+python scripts/preprocessing/warm-local-cache.py --local_cache_dir /scratch/osv5m \
+    --local_cache_gb 500 --splits test train --manifest datasets/osv5m/cache/warm.txt
+"""
+
+import os
+import sys
+from os.path import dirname, abspath, join, relpath, isfile
+
+sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+from data.data import osv5m
+from data.image_cache import LocalFileCache
+
+
+def split_files(dataset):
+    """Lists the files of the dataset read for the samples of a split."""
+    if dataset.storage == "shards":
+        shards = dataset.shards
+        used = sorted({shards.locate(int(img_id))[0] for img_id in dataset.ids})
+        return [shards.shard_path(shard) for shard in used]
+    if dataset.storage == "archives":
+        return list(dataset.archives.archives)
+    return [dataset.image_index.path(int(img_id)) for img_id in dataset.ids]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default="datasets/osv5m")
+    parser.add_argument("--local_cache_dir", required=True)
+    parser.add_argument("--local_cache_gb", type=float, required=True)
+    parser.add_argument("--splits", nargs="+", default=["test"])
+    parser.add_argument("--storage", default="folder")
+    parser.add_argument("--manifest", default=None)
+    parser.add_argument("--num_threads", type=int, default=16)
+    args = parser.parse_args()
+
+    cache = LocalFileCache(args.data_dir, args.local_cache_dir, args.local_cache_gb * 1e9)
+    manifest = args.manifest
+    if manifest is None or not isfile(manifest):
+        files = []
+        for split in args.splits:
+            dataset = osv5m(args.data_dir, None, split=split, storage=args.storage)
+            files += split_files(dataset)
+        files = list(dict.fromkeys(relpath(path, args.data_dir) for path in files))
+        if manifest is None:
+            manifest = join(args.local_cache_dir, f"warm-up.{os.getpid()}.txt")
+        with open(manifest, "w") as f:
+            f.write("\n".join(files) + "\n")
+        print(f"Listed {len(files)} files of {args.splits} in {manifest}")
+    num_files = cache.warm_up(manifest, num_threads=args.num_threads)
+    if args.manifest is None:
+        os.remove(manifest)
+    print(f"{num_files} files of the manifest in the cache at {cache.directory}")
+    print(cache.stats())
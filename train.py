@@ -73,6 +73,8 @@ def callback_init(cfg):
     progress_bar = instantiate(cfg.progress_bar)
     lr_monitor = LearningRateMonitor()
     callbacks = [checkpoint_callback, progress_bar, lr_monitor]
+    if cfg.checkpoint_every_n_train_steps is not None:
+        callbacks.append(instantiate(cfg.step_checkpoints))
     return callbacks
 
 